@@ -0,0 +1,362 @@
+# asgi version of the routes in main.py, for running the
+# image server as one process handling every request on an
+# event loop, with rendering sent to a pool sized to the
+# cores instead of being limited by the number of sync
+# workers (a slow client only holds a coroutine, not a
+# worker). shares everything else (images, cache, formats,
+# configuration) with main.py
+#
+# example usage:
+# $ uvicorn api.image.asgi:app --port 5000
+#
+# every environment variable in main.py is used the same
+# way, except PRERENDER_THREADS (prerendering uses the
+# render pool). with RENDER_POOL=process, set METRICS_DIR
+# so /metrics includes the renders of each process
+
+import asyncio
+from concurrent import futures
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+import urllib.parse
+
+from api.image import cache, crops, main
+
+# RENDER_POOL
+# "thread" or "process". Pillow releases the gil while
+# cropping and encoding, so threads scale with cores for
+# most formats and share the cache. Processes are forked
+# after images are loaded, sharing their memory
+# Default: "thread"
+RENDER_POOL = os.getenv("RENDER_POOL", "thread")
+
+# RENDER_WORKERS
+# The number of threads or processes used to render
+# Default: the number of cores
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0")) or os.cpu_count() or 1
+
+# MAX_QUEUED_RENDERS
+# The number of renders which can be waiting for a worker
+# before requests needing a new render get a 503, so a
+# burst can't queue unbounded work and memory. Cached and
+# in progress images are always served
+# Default: 16 per worker
+MAX_QUEUED_RENDERS = int(os.getenv("MAX_QUEUED_RENDERS", "0")) or RENDER_WORKERS*16
+
+# CHUNK_SIZE
+# Responses are sent in chunks of this many bytes, each
+# waiting for the client to accept the previous one, so
+# a slow client only holds one chunk of socket buffer
+CHUNK_SIZE = 64*1024
+
+render_pool: futures.Executor = (
+    futures.ProcessPoolExecutor(RENDER_WORKERS)
+    if RENDER_POOL == "process"
+    else futures.ThreadPoolExecutor(RENDER_WORKERS, "render")
+)
+
+# renders which were submitted but haven't finished, so
+# identical requests wait for the same render. only used
+# from the event loop, so it needs no lock
+pending_renders: Dict[str, "asyncio.Future[cache.CacheEntry]"] = {}
+# keeps prerender renders referenced until they finish
+background_tasks: Set["asyncio.Future[cache.CacheEntry]"] = set()
+
+_Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class _HTTPError(Exception):
+    def __init__(self, status: int):
+        super().__init__(status)
+        self.status = status
+
+
+def _render(char_id: str, rect: Tuple[int, int, int, int], mode: str) -> cache.CacheEntry:
+    # runs in the render pool
+    stream, format = main._get_byte_stream(char_id, rect, mode)
+    return (stream.getvalue(), format)
+
+
+async def _wait_for_render(
+    char_id: str,
+    rect: Tuple[int, int, int, int],
+    mode: str,
+    key: str,
+) -> cache.CacheEntry:
+    try:
+        entry = await asyncio.get_running_loop().run_in_executor(
+            render_pool, _render, char_id, rect, mode,
+        )
+        main.image_cache.put(key, entry)
+        return entry
+    finally:
+        del pending_renders[key]
+
+
+def generate(char_id: str, x: int, y: int, size: int, mode: str) -> "asyncio.Future[cache.CacheEntry]":
+    im = main.images[char_id]
+    rect = main._center_and_nudge(x, y, size, im.width, im.height)
+    key = main._get_cache_key(char_id, rect, mode)
+
+    future = pending_renders.get(key)
+    if future is not None:
+        return future
+
+    loop = asyncio.get_running_loop()
+    entry = main.image_cache.get(key)
+    corpus_index = main.corpus_index
+    if entry is None and corpus_index is not None:
+        corpus_file = corpus_index.get(key)
+        if corpus_file is not None:
+            # small files, mostly in the page cache, so reading
+            # them on the event loop is cheaper than a thread hop
+            entry = (corpus_index.read(corpus_file), corpus_file[1])
+    if entry is not None:
+        future = loop.create_future()
+        future.set_result(entry)
+        return future
+
+    if len(pending_renders) >= MAX_QUEUED_RENDERS + RENDER_WORKERS:
+        raise _HTTPError(503)
+    future = asyncio.ensure_future(_wait_for_render(char_id, rect, mode, key))
+    pending_renders[key] = future
+    return future
+
+
+def prerender(char_id: str, x: int, y: int, difficulty: int, mode: str) -> None:
+    if not main.PRERENDER:
+        return
+    for step in range(crops.LAST_STEP+1):
+        size = crops.get_size(step, difficulty)
+        if main.get_corpus_file(char_id, x, y, size, mode) is not None:
+            continue
+        try:
+            future = generate(char_id, x, y, size, mode)
+        except _HTTPError:
+            # busy: the images will be rendered on request
+            return
+        background_tasks.add(future)
+        future.add_done_callback(background_tasks.discard)
+
+
+def _get_args(query: Dict[str, List[str]], **arguments: Any) -> Dict[str, Any]:
+    # same as main.convert_args
+    args: Dict[str, Any] = {}
+    for arg, converter in arguments.items():
+        if type(converter) == tuple:
+            converter, default = converter
+        else:
+            default = None
+
+        if arg not in query:
+            if default is None:
+                raise _HTTPError(422)
+            args[arg] = default
+            continue
+        try:
+            args[arg] = converter(query[arg][0])
+        except ValueError:
+            raise _HTTPError(422)
+    return args
+
+
+async def _respond(
+    send: _Send,
+    status: int,
+    headers: Dict[str, str],
+    body: Sequence[bytes] = (),
+    send_body: bool = True,
+) -> None:
+    length = sum(len(part) for part in body)
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (name.lower().encode(), value.encode())
+            for name, value in {**headers, "Content-Length": str(length)}.items()
+        ],
+    })
+    if not send_body:
+        await send({"type": "http.response.body", "body": b""})
+        return
+
+    # each send waits until the server has room for more,
+    # so slow clients push back instead of buffering
+    chunks = [
+        part[i:i+CHUNK_SIZE]
+        for part in body
+        for i in range(0, len(part), CHUNK_SIZE)
+    ]
+    for i, chunk in enumerate(chunks):
+        await send({
+            "type": "http.response.body",
+            "body": chunk,
+            "more_body": i < len(chunks)-1,
+        })
+    if len(chunks) == 0:
+        await send({"type": "http.response.body", "body": b""})
+
+
+async def get_random_new(query: Dict[str, List[str]], send: _Send, head: bool) -> None:
+    args = _get_args(
+        query,
+        difficulty=(int, 0), charset=(int, 0),
+        mode=(str, main.DEFAULT_FORMAT), seed=(str, ""),
+    )
+    if args["mode"] not in main.FILE_FORMATS:
+        raise _HTTPError(422)
+
+    rng = main.get_round_rng(args["seed"], args["charset"], args["difficulty"])
+    char_id = main.get_random_char_id(args["charset"], args["difficulty"], rng)
+    if char_id is None:
+        raise _HTTPError(422)
+    index = main.get_center_index(char_id, crops.get_size(0, args["difficulty"]), main.DEFAULT_THRESHOLD)
+    if len(index.valid) == 0:
+        raise _HTTPError(422)
+    x, y = main.get_new_position(index, rng)
+    prerender(char_id, x, y, args["difficulty"], args["mode"])
+
+    await _respond(send, 303, {
+        "Location": main.get_link(char_id, x, y, 0, args["difficulty"], args["mode"]),
+    }, send_body=not head)
+
+
+async def get_round(query: Dict[str, List[str]], send: _Send, head: bool) -> None:
+    args = _get_args(
+        query,
+        difficulty=(int, 0), charset=(int, 0),
+        mode=(str, main.DEFAULT_FORMAT), send_images=(int, 1), seed=(str, ""),
+    )
+    difficulty: int = args["difficulty"]
+    mode: str = args["mode"]
+    if mode not in main.FILE_FORMATS:
+        raise _HTTPError(422)
+
+    rng = main.get_round_rng(args["seed"], args["charset"], difficulty)
+    char_id = main.get_random_char_id(args["charset"], difficulty, rng)
+    if char_id is None:
+        raise _HTTPError(422)
+    index = main.get_center_index(char_id, crops.get_size(0, difficulty), main.DEFAULT_THRESHOLD)
+    if len(index.valid) == 0:
+        raise _HTTPError(422)
+    x, y = main.get_new_position(index, rng)
+
+    # every step renders at once
+    entries = await asyncio.gather(*[
+        generate(char_id, x, y, crops.get_size(step, difficulty), mode)
+        for step in range(crops.LAST_STEP+1)
+    ])
+
+    metadata = {
+        "char_id": char_id,
+        "x": x,
+        "y": y,
+        "difficulty": difficulty,
+        "mode": mode,
+        "steps": [
+            {
+                "link": main.get_link(char_id, x, y, step, difficulty, mode),
+                "format": format,
+                "length": len(data) if args["send_images"] else 0,
+            }
+            for step, (data, format) in enumerate(entries)
+        ],
+    }
+    # same format as main._encode_round
+    header = json.dumps(metadata).encode()
+    body = [len(header).to_bytes(4, "big"), header]
+    if args["send_images"]:
+        body.extend(data for data, _ in entries)
+    await _respond(send, 200, {"Content-Type": "application/octet-stream"}, body, not head)
+
+
+async def generate_handler(char_id: str, query: Dict[str, List[str]], send: _Send, head: bool) -> None:
+    if char_id not in main.images:
+        raise _HTTPError(404)
+    args = _get_args(query, x=int, y=int, step=int, difficulty=int, mode=(str, main.DEFAULT_FORMAT))
+    x: int = args["x"]
+    y: int = args["y"]
+    step: int = args["step"]
+    difficulty: int = args["difficulty"]
+    mode: str = args["mode"]
+    if mode not in main.FILE_FORMATS:
+        raise _HTTPError(422)
+    size = crops.get_size(step, difficulty)
+    if size < 1:
+        raise _HTTPError(422)
+
+    headers: Dict[str, str] = {}
+    if step < crops.LAST_STEP:
+        headers["Link"] = main.make_link_header(char_id, x, y, step+1, difficulty, mode)
+
+    if head:
+        # no rendering, see main.generate_handler
+        await _respond(send, 200, headers, send_body=False)
+        return
+
+    data, format = await generate(char_id, x, y, size, mode)
+    headers["Content-Type"] = f"image/{format}"
+    await _respond(send, 200, headers, [data])
+
+
+async def cache_stats(send: _Send) -> None:
+    stats = {**main.image_cache.stats(), "pending": len(pending_renders)}
+    await _respond(send, 200, {"Content-Type": "application/json"}, [json.dumps(stats).encode()])
+
+
+async def metrics_handler(send: _Send) -> None:
+    await _respond(
+        send, 200,
+        {"Content-Type": "text/plain; version=0.0.4"},
+        [main.metrics_registry.expose().encode()],
+    )
+
+
+async def app(scope: Dict[str, Any], receive: Callable[[], Awaitable[Dict[str, Any]]], send: _Send) -> None:
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                render_pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    method: str = scope["method"]
+    path: str = scope["path"]
+    query = urllib.parse.parse_qs(scope["query_string"].decode())
+    head = method == "HEAD"
+    start = time.perf_counter_ns()
+    # same labels as the flask routes
+    route: Optional[str] = None
+
+    try:
+        if method != "GET" and not head:
+            raise _HTTPError(405)
+        if path == "/new":
+            route = "/new"
+            await get_random_new(query, send, head)
+        elif path == "/round":
+            route = "/round"
+            await get_round(query, send, head)
+        elif path == "/cache":
+            await cache_stats(send)
+        elif path == "/metrics":
+            await metrics_handler(send)
+        elif path.count("/") == 1 and len(path) > 1:
+            route = "/<char_id>"
+            await generate_handler(path[1:], query, send, head)
+        else:
+            raise _HTTPError(404)
+    except _HTTPError as e:
+        headers: Dict[str, str] = {}
+        if e.status == 503:
+            headers["Retry-After"] = "1"
+        await _respond(send, e.status, headers)
+    if route is not None:
+        main.REQUEST_SECONDS.observe((route,), (time.perf_counter_ns()-start)/1000000000)
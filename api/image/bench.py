@@ -0,0 +1,215 @@
+# load generator for the image server: plays N games at
+# once, each round being a /new (or /round) request then a
+# GET of every step, spaced like a real game, and reports
+# latency percentiles, throughput, bytes sent and the time
+# spent in each phase on the server (from the Server-Timing
+# header main.py adds to every response)
+#
+# example usage (synthetic images, then a local server):
+# $ python -m api.image.bench synth "bench-images" --count 30
+# $ IMAGE_PATH=bench-images FORMAT_PATH=gamedata/formats.json \
+#     gunicorn api.image.main:app
+# $ python -m api.image.bench run --games 20 --rounds 3 --interval 0.5
+#
+# options of run:
+#   --url URL: the server (default: http://127.0.0.1:5000)
+#   --games N: games played at once (default: 10)
+#   --rounds N: rounds per game (default: 3)
+#   --interval S: seconds between steps of a round
+#     (default: 0.5, real games use 5)
+#   --mode MODE: format name to request (default: server's)
+#   --round: get each round from /round in one request
+#     instead of /new and one request per step
+#   --seed SEED: play seeded rounds (round r of game g uses
+#     the seed "SEED-g-r"), so runs can be replayed exactly
+
+import argparse
+import http.client
+import random
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+import urllib.parse
+
+import numpy as np
+from PIL import Image
+
+
+class _Sample(NamedTuple):
+    route: str
+    ms: float
+    bytes: int
+    status: int
+    # phase -> ms, from Server-Timing
+    phases: Dict[str, float]
+
+
+def _parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    # "crop;dur=1.2, encode;dur=3.4"
+    phases: Dict[str, float] = {}
+    if header is None:
+        return phases
+    for metric in header.split(","):
+        name, _, params = metric.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                phases[name] = float(value)
+    return phases
+
+
+def _percentile(values: List[float], p: float) -> float:
+    # nearest rank
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values)-1, max(0, int(-(-p*len(values)//100))-1))]
+
+
+class _Game(threading.Thread):
+    def __init__(self, number: int, url: urllib.parse.ParseResult, args: argparse.Namespace, samples: List[_Sample]):
+        super().__init__(daemon=True)
+        self._number = number
+        self._url = url
+        self._args = args
+        self._samples = samples
+        self._conn = http.client.HTTPConnection(url.hostname or "127.0.0.1", url.port or 80, timeout=60)
+
+    def _get(self, route: str, path: str, method: str = "GET") -> http.client.HTTPResponse:
+        s = time.perf_counter_ns()
+        self._conn.request(method, path)
+        res = self._conn.getresponse()
+        body = res.read()
+        e = time.perf_counter_ns()
+        # list.append is atomic
+        self._samples.append(_Sample(
+            route, (e-s)/1000000, len(body), res.status,
+            _parse_server_timing(res.getheader("Server-Timing")),
+        ))
+        return res
+
+    def _query(self, round: int) -> str:
+        query = {}
+        if self._args.mode is not None:
+            query["mode"] = self._args.mode
+        if self._args.seed is not None:
+            query["seed"] = f"{self._args.seed}-{self._number}-{round}"
+        return urllib.parse.urlencode(query)
+
+    def _play_round(self, round: int) -> None:
+        if self._args.round:
+            self._get("/round", f"/round?{self._query(round)}")
+            # the game still shows each step for an interval
+            time.sleep(self._args.interval*6)
+            return
+
+        res = self._get("/new", f"/new?{self._query(round)}")
+        link = res.getheader("Location")
+        if res.status != 303 or link is None:
+            return
+        step = 0
+        while link is not None:
+            start = time.perf_counter()
+            link = urllib.parse.urlparse(link)._replace(scheme="", netloc="").geturl()
+            res = self._get(f"/<char_id> step {step}", link)
+            next_link = res.getheader("Link")
+            link = None if next_link is None else next_link[1:next_link.index(">")]
+            step += 1
+            time.sleep(max(0, start + self._args.interval - time.perf_counter()))
+
+    def run(self) -> None:
+        # stagger the games like real ones
+        time.sleep(random.random()*self._args.interval)
+        for round in range(self._args.rounds):
+            self._play_round(round)
+
+
+def run(args: argparse.Namespace) -> None:
+    url = urllib.parse.urlparse(args.url)
+    samples: List[_Sample] = []
+    games = [_Game(i, url, args, samples) for i in range(args.games)]
+
+    s = time.perf_counter()
+    for game in games:
+        game.start()
+    for game in games:
+        game.join()
+    elapsed = time.perf_counter()-s
+
+    routes: Dict[str, List[_Sample]] = {}
+    for sample in samples:
+        routes.setdefault(sample.route, []).append(sample)
+
+    print(f"{len(samples)} requests in {elapsed:.2f}s: {len(samples)/elapsed:.1f} req/s")
+    print(f"{sum(sample.bytes for sample in samples)/1000000:.2f} MB sent")
+    errors = sum(1 for sample in samples if sample.status >= 400)
+    if errors > 0:
+        print(f"{errors} errors")
+
+    print(f"\n{'route':<22}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}{'mean KB':>10}")
+    for route, route_samples in sorted(routes.items()):
+        ms = [sample.ms for sample in route_samples]
+        print(
+            f"{route:<22}{len(route_samples):>7}"
+            f"{_percentile(ms, 50):>10.2f}{_percentile(ms, 99):>10.2f}"
+            f"{sum(sample.bytes for sample in route_samples)/len(route_samples)/1000:>10.1f}"
+        )
+
+    phases: Dict[str, List[float]] = {}
+    for sample in samples:
+        for phase, phase_ms in sample.phases.items():
+            phases.setdefault(phase, []).append(phase_ms)
+    if len(phases) > 0:
+        print(f"\n{'phase':<22}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}{'total s':>10}")
+        for phase, durations in sorted(phases.items()):
+            print(
+                f"{phase:<22}{len(durations):>7}"
+                f"{_percentile(durations, 50):>10.2f}{_percentile(durations, 99):>10.2f}"
+                f"{sum(durations)/1000:>10.2f}"
+            )
+
+
+def synth(args: argparse.Namespace) -> None:
+    # roughly like character art: an opaque noisy blob in
+    # the middle of a transparent canvas, with soft edges
+    rng = np.random.default_rng(args.seed)
+    for i in range(args.count):
+        width = int(rng.integers(400, 1024))
+        height = int(rng.integers(600, 1024))
+        yy, xx = np.mgrid[0:height, 0:width]
+        distance = np.hypot((xx-width/2)/(width*0.4), (yy-height/2)/(height*0.45))
+        alpha = np.clip((1-distance)*1020, 0, 255).astype(np.uint8)
+        rgb = rng.integers(0, 256, (height//16+1, width//16+1, 3), dtype=np.uint8)
+        rgb = np.asarray(Image.fromarray(rgb).resize((width, height), Image.Resampling.BILINEAR))
+        pixels = np.dstack((rgb, alpha))
+        Image.fromarray(pixels, "RGBA").save(f"{args.dest}/char_{i:03d}_bench{i}_1.png")
+        print(f"char_{i:03d}_bench{i}_1.png")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--url", default="http://127.0.0.1:5000")
+    run_parser.add_argument("--games", type=int, default=10)
+    run_parser.add_argument("--rounds", type=int, default=3)
+    run_parser.add_argument("--interval", type=float, default=0.5)
+    run_parser.add_argument("--mode")
+    run_parser.add_argument("--round", action="store_true")
+    run_parser.add_argument("--seed")
+
+    synth_parser = commands.add_parser("synth")
+    synth_parser.add_argument("dest")
+    synth_parser.add_argument("--count", type=int, default=30)
+    synth_parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        synth(args)
+
+
+if __name__ == "__main__":
+    main()
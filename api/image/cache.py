@@ -0,0 +1,210 @@
+# caches for encoded images, so repeatedly requesting the
+# same crop (every player in a round, HEAD-then-GET, every
+# web node) only runs pillow once
+
+import abc
+import collections
+import threading
+from typing import Optional, OrderedDict, Tuple
+
+# (encoded bytes, format name)
+CacheEntry = Tuple[bytes, str]
+
+
+class ImageCache(abc.ABC):
+    """Interface for encoded image storage
+
+    Implementations must be safe to use from multiple threads.
+    """
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[CacheEntry]:
+        pass
+
+    @abc.abstractmethod
+    def __contains__(self, key: str) -> bool:
+        # whether get would find the key, without counting a
+        # hit or miss or fetching the image
+        pass
+
+    @abc.abstractmethod
+    def put(self, key: str, entry: CacheEntry) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+class NullCache(ImageCache):
+    """Cache which never stores anything (caching disabled)"""
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        return None
+
+    def __contains__(self, key: str) -> bool:
+        return False
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        pass
+
+
+class MemoryCache(ImageCache):
+    """In-process LRU cache bounded by the total encoded size
+
+    Args:
+        max_bytes (int): The total size of stored images above
+            which the least recently used images are evicted.
+    """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._entries: OrderedDict[str, CacheEntry] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        size = len(entry[0])
+        # don't let one huge image flush everything else
+        if size > self._max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[key] = entry
+            self._bytes += size
+
+            while self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[0])
+                self._evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
+
+
+class RedisCache(ImageCache):
+    """Cache shared between processes and servers through redis
+
+    A redis server which is down or slow is treated like an
+    empty cache, so images are rendered instead of failing.
+
+    Args:
+        url (str): The redis connection url, e.g.
+            redis://localhost:6379/0
+        ttl (int): The number of seconds each image is kept for.
+        timeout (float): The number of seconds to wait for redis
+            before giving up on a request.
+    """
+
+    def __init__(self, url: str, ttl: int, timeout: float = 0.5):
+        # only needed when a shared cache is configured
+        import redis
+
+        self._redis = redis.Redis.from_url(
+            url,
+            socket_timeout=timeout,
+            socket_connect_timeout=timeout,
+        )
+        self._error = redis.RedisError
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+
+    def _count_error(self) -> None:
+        with self._lock:
+            self._errors += 1
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        try:
+            value = self._redis.get(f"image-cache:{key}")
+        except self._error:
+            self._count_error()
+            value = None
+        with self._lock:
+            if value is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+        # stored as b"<format>\0<bytes>"
+        format, _, data = value.partition(b"\0")
+        return (data, format.decode())
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            return self._redis.exists(f"image-cache:{key}") > 0
+        except self._error:
+            self._count_error()
+            return False
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        data, format = entry
+        try:
+            self._redis.set(
+                f"image-cache:{key}",
+                format.encode() + b"\0" + data,
+                ex=self._ttl,
+            )
+        except self._error:
+            # the image was still rendered for this request
+            self._count_error()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self._hits, "misses": self._misses, "errors": self._errors}
+
+
+class TieredCache(ImageCache):
+    """Checks a fast cache before a slow (shared) one, filling
+    the fast cache with anything found in the slow one
+    """
+
+    def __init__(self, fast: ImageCache, slow: ImageCache):
+        self._fast = fast
+        self._slow = slow
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        entry = self._fast.get(key)
+        if entry is None:
+            entry = self._slow.get(key)
+            if entry is not None:
+                self._fast.put(key, entry)
+        return entry
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._fast or key in self._slow
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        self._fast.put(key, entry)
+        self._slow.put(key, entry)
+
+    def stats(self) -> dict:
+        return {"local": self._fast.stats(), "shared": self._slow.stats()}
@@ -0,0 +1,112 @@
+# pre-rendered images: every step of every seeded starting
+# position (see SEEDED_POSITIONS in main.py) of every image,
+# encoded ahead of time so the image server only reads
+# files instead of running pillow. renders which aren't in
+# the corpus are still made live. corpora are built by
+# gamedata/render_corpus.py
+#
+# layout of a corpus folder:
+#   manifest.json: cache key of each render (see
+#     main._get_cache_key) -> [path in objects, format name],
+#     a fingerprint of each formats.json mode (its settings
+#     and the encoders chosen for its auto tiers, see
+#     main.get_format_fingerprint) and a hash of each image
+#     (see main.get_image_hash), so renders made with other
+#     settings, calibration or source images aren't used
+#   objects/: the encoded images, named by the sha256 of
+#     their contents, so identical renders (e.g. positions
+#     nudged to the same crop) are only stored once
+
+import hashlib
+import json
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# change whenever the layout of the corpus changes
+CORPUS_VERSION = 2
+MANIFEST_FILE = "manifest.json"
+OBJECTS_DIR = "objects"
+
+# (path in objects, format name)
+CorpusFile = Tuple[str, str]
+
+
+def get_fingerprint(settings: List[dict], auto_choices: List[Any]) -> str:
+    return hashlib.sha256(json.dumps(
+        {"settings": settings, "auto": auto_choices},
+        sort_keys=True,
+    ).encode()).hexdigest()
+
+
+class Corpus(object):
+    """Manifest of a corpus folder, for looking up renders
+
+    Args:
+        path (str): The corpus folder.
+        fingerprints (Dict[str, str]): The current fingerprint of
+            each formats.json mode. Renders of modes whose
+            fingerprint changed since the corpus was built are
+            ignored.
+        get_image_hash (Callable[[str], str]): Gives the current
+            hash of an image from its char_id, which must be
+            cheap (e.g. recorded when the image was loaded).
+            Renders of images whose hash changed since the
+            corpus was built are ignored.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        fingerprints: Dict[str, str],
+        get_image_hash: Callable[[str], str],
+    ):
+        self.path = path
+        with open(os.path.join(path, MANIFEST_FILE), encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["version"] != CORPUS_VERSION:
+            raise RuntimeError(f"unsupported corpus version {manifest['version']}")
+
+        modes = {
+            mode for mode, fingerprint in manifest["formats"].items()
+            if fingerprints.get(mode) == fingerprint
+        }
+        stale = set(manifest["formats"]) - modes
+        if len(stale) > 0:
+            print(f"ignoring corpus renders of changed formats: {', '.join(sorted(stale))}")
+
+        self.files: Dict[str, CorpusFile] = {
+            key: (name, format)
+            for key, (name, format) in manifest["renders"].items()
+            # the mode is the last part of the key
+            if key[key.rindex(":")+1:] in modes
+        }
+
+        self._image_hashes: Dict[str, str] = manifest["images"]
+        self._get_image_hash = get_image_hash
+        # char_id -> whether the image is the one the corpus
+        # was built from, filled in as images are looked up
+        self._is_current: Dict[str, bool] = {}
+
+    def is_current(self, char_id: str) -> bool:
+        is_current = self._is_current.get(char_id)
+        if is_current is None:
+            # a race only compares the hashes twice
+            is_current = self._image_hashes.get(char_id) == self._get_image_hash(char_id)
+            self._is_current[char_id] = is_current
+            if not is_current and char_id in self._image_hashes:
+                print(f"ignoring corpus renders of changed image {char_id}")
+        return is_current
+
+    def get(self, key: str) -> Optional[CorpusFile]:
+        file = self.files.get(key)
+        # the char_id is the first part of the key
+        if file is None or not self.is_current(key[:key.index(":")]):
+            return None
+        return file
+
+    def get_path(self, file: CorpusFile) -> str:
+        return os.path.join(self.path, OBJECTS_DIR, file[0])
+
+    def read(self, file: CorpusFile) -> bytes:
+        with open(self.get_path(file), "rb") as f:
+            return f.read()
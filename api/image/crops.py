@@ -0,0 +1,106 @@
+# which parts of an image can be cropped for a round,
+# shared by the image server (main.py) and the scripts in
+# gamedata/ which precompute data for it, so they can't
+# disagree. only needs numpy and pillow, so the scripts
+# can import it without the server's dependencies
+#
+# the bot (discord-bot/cannedthighs/opacity.py) is deployed
+# on its own and keeps its own copy of get_opaque_table
+
+from typing import NamedTuple, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def get_summed_table(mask: np.ndarray) -> np.ndarray:
+    # table[y, x] is the number of true pixels of the 2d
+    # mask in the rect (0, 0, x, y), so the count inside
+    # any rect can be found with 4 lookups instead of a
+    # crop and a histogram. the extra row and column of
+    # zeros means rects touching the top/left edge don't
+    # need special cases
+    height, width = mask.shape
+    table = np.zeros((height+1, width+1), dtype=np.uint32)
+    mask.cumsum(axis=0, dtype=np.uint32, out=table[1:, 1:])
+    table[1:, 1:].cumsum(axis=1, dtype=np.uint32, out=table[1:, 1:])
+    return table
+
+
+def get_rect_count(table: np.ndarray, rect: Tuple[int, int, int, int]) -> int:
+    # number of true pixels inside rect (left, top, right,
+    # bottom) of a table from get_summed_table
+    left, top, right, bottom = rect
+    return (
+        int(table[bottom, right]) - int(table[top, right])
+        - int(table[bottom, left]) + int(table[top, left])
+    )
+
+
+def get_opaque_table(im: Image.Image) -> np.ndarray:
+    # summed-area table of fully opaque pixels
+    return get_summed_table(np.asarray(im.getchannel("A")) == 255)
+
+
+# default amount of empty space to ignore around each image
+# and spacing in pixels between candidate center points, see
+# PADDING and CENTER_STEP in main.py
+DEFAULT_PADDING = 40
+DEFAULT_CENTER_STEP = 4
+
+# the last step of each round, after which no
+# Link header is given
+LAST_STEP = 5  # todo: use difficulty
+
+
+def get_size(step: int, difficulty: int) -> int:
+    # difficulty only picks which images are used (see
+    # ANALYSIS_PATH in main.py), sizes stay the same as
+    # the bot's
+    return (9*step + 34)*step + 69
+
+
+class CenterIndex(NamedTuple):
+    # candidate center coordinates along each axis
+    xs: np.ndarray
+    ys: np.ndarray
+    # flat indices (y_index*len(xs) + x_index) of the
+    # candidates which pass the opacity threshold
+    valid: np.ndarray
+
+
+def get_center_index(
+    table: np.ndarray,
+    size: int, threshold: float,
+    padding: int = DEFAULT_PADDING,
+    center_step: int = DEFAULT_CENTER_STEP,
+) -> CenterIndex:
+    # same rects as main._center_and_nudge, but for every
+    # candidate center at once
+    height = table.shape[0]-1
+    width = table.shape[1]-1
+    half_size = size//2
+
+    xs = np.arange(padding, width-padding, center_step)
+    if len(xs) == 0:
+        xs = np.array([width//2])
+    ys = np.arange(padding, height-padding, center_step)
+    if len(ys) == 0:
+        ys = np.array([height//2])
+
+    x0 = np.maximum(np.minimum(xs-half_size, width-size), 0)
+    y0 = np.maximum(np.minimum(ys-half_size, height-size), 0)
+    x1 = x0 + min(size, width)
+    y1 = y0 + min(size, height)
+
+    def corner(ys: np.ndarray, xs: np.ndarray) -> np.ndarray:
+        # int64 so the subtraction can't wrap around
+        return table[np.ix_(ys, xs)].astype(np.int64)
+
+    counts = (
+        corner(y1, x1) - corner(y0, x1)
+        - corner(y1, x0) + corner(y0, x0)
+    )
+    area = min(size, width)*min(size, height)
+    valid = np.flatnonzero(counts >= threshold*area).astype(np.uint32)
+    return CenterIndex(xs, ys, valid)
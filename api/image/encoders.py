@@ -0,0 +1,246 @@
+# picks an encoder for formats whose format is "auto",
+# from cost curves measured on the real images instead of
+# hand tuned maxsize tiers
+#
+# an auto setting in formats.json looks like:
+#   {
+#     "maxsize": 500,
+#     "format": "auto",
+#     "reduce": 1,
+#     "target_bytes": 20000,
+#     "budget_ms": 5,
+#     "min_psnr": 35,
+#     "args": {...}
+#   }
+# where args are the webp arguments to fall back on when
+# no calibration file exists (this is also what the discord
+# bot uses for auto settings).
+#
+# for every size bucket and opacity class, the candidate
+# encoders which are fast enough (mean encode time within
+# budget_ms) and good enough (mean psnr at least min_psnr)
+# are considered. if any of them are small enough (mean
+# size within target_bytes) the fastest of those is used,
+# otherwise the smallest. jpeg is only a candidate for
+# fully opaque crops, since it has no alpha channel
+#
+# the calibration file is built by sampling random crops
+# from every image and encoding each with every candidate:
+# $ python -m api.image.encoders "images" "calibration.json" [samples per image]
+
+import io
+import json
+import math
+import os
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+# (format, args)
+Encoder = Tuple[str, Dict[str, Any]]
+
+CANDIDATES: List[Encoder] = [
+    ("webp", {"lossless": True, "quality": 50, "method": 0}),
+    *[
+        ("webp", {"lossless": False, "quality": quality, "method": method})
+        for quality in (50, 60, 70, 80)
+        for method in (0, 4)
+    ],
+    *[
+        ("jpeg", {"quality": quality})
+        for quality in (60, 75, 85)
+    ],
+]
+
+# upper limits of the size (max of width and height)
+# of the encoded image in each bucket
+BUCKETS = [64, 128, 256, 512, 1024, 2048]
+
+# psnr recorded for lossless encoders
+LOSSLESS_PSNR = 100.0
+
+
+def get_bucket(dim: int) -> int:
+    for bucket in BUCKETS:
+        if dim <= bucket:
+            return bucket
+    return BUCKETS[-1]
+
+
+def get_class(fully_opaque: bool) -> str:
+    return "opaque" if fully_opaque else "alpha"
+
+
+def encode(im: Image.Image, encoder: Encoder, buf: io.BytesIO) -> str:
+    format, args = encoder
+    if format == "jpeg" and im.mode != "RGB":
+        im = im.convert("RGB")
+    im.save(buf, format, **args)
+    return format
+
+
+def _get_psnr(original: Image.Image, data: bytes) -> float:
+    with Image.open(io.BytesIO(data)) as decoded:
+        a = np.asarray(original.convert("RGB"), dtype=np.float64)
+        b = np.asarray(decoded.convert("RGB"), dtype=np.float64)
+    # only compare pixels the player can actually see
+    visible = np.asarray(original.getchannel("A")) > 0
+    if not visible.any():
+        return LOSSLESS_PSNR
+    mse = ((a-b)**2)[visible].mean()
+    if mse == 0:
+        return LOSSLESS_PSNR
+    return min(10*math.log10(255**2/mse), LOSSLESS_PSNR)
+
+
+def calibrate(image_path: str, out_path: str, samples: int = 20) -> None:
+    # totals[class][bucket][candidate index] = [count, bytes, ms, psnr]
+    totals: Dict[str, Dict[int, List[List[float]]]] = {
+        cls: {bucket: [[0, 0, 0, 0] for _ in CANDIDATES] for bucket in BUCKETS}
+        for cls in ("opaque", "alpha")
+    }
+
+    for file in sorted(os.listdir(image_path)):
+        path = os.path.join(image_path, file)
+        if not os.path.isfile(path):
+            continue
+        with Image.open(path) as source:
+            im = source.convert("RGBA")
+        print(file)
+
+        for _ in range(samples):
+            size = random.randint(16, max(im.width, im.height))
+            x = random.randint(0, max(im.width-size, 0))
+            y = random.randint(0, max(im.height-size, 0))
+            crop = im.crop((x, y, min(x+size, im.width), min(y+size, im.height)))
+            alpha = crop.getchannel("A")
+            if alpha.getextrema()[0] == 0 and alpha.getextrema()[1] == 0:
+                # fully transparent crops are never sent
+                continue
+            fully_opaque = alpha.getextrema()[0] == 255
+            bucket = get_bucket(max(crop.width, crop.height))
+
+            for i, encoder in enumerate(CANDIDATES):
+                if encoder[0] == "jpeg" and not fully_opaque:
+                    continue
+                buf = io.BytesIO()
+                s = time.perf_counter_ns()
+                encode(crop, encoder, buf)
+                e = time.perf_counter_ns()
+                data = buf.getvalue()
+
+                total = totals[get_class(fully_opaque)][bucket][i]
+                total[0] += 1
+                total[1] += len(data)
+                total[2] += (e-s)/1000000
+                total[3] += (
+                    LOSSLESS_PSNR
+                    if encoder[1].get("lossless", False)
+                    else _get_psnr(crop, data)
+                )
+
+    curves: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+    for cls, buckets in totals.items():
+        curves[cls] = {}
+        for bucket, candidates in buckets.items():
+            curves[cls][str(bucket)] = [
+                {
+                    "format": encoder[0],
+                    "args": encoder[1],
+                    "bytes": total[1]/total[0],
+                    "ms": total[2]/total[0],
+                    "psnr": total[3]/total[0],
+                }
+                for encoder, total in zip(CANDIDATES, candidates)
+                if total[0] > 0
+            ]
+
+    with open(out_path, "w") as out_file:
+        json.dump({"buckets": BUCKETS, "curves": curves}, out_file, indent=2)
+
+
+def _choose(curve: List[Dict[str, Any]], setting: dict) -> Optional[Encoder]:
+    usable = [
+        point for point in curve
+        if point["ms"] <= setting.get("budget_ms", math.inf)
+        and point["psnr"] >= setting.get("min_psnr", 0)
+    ]
+    if len(usable) == 0:
+        return None
+
+    small = [
+        point for point in usable
+        if point["bytes"] <= setting.get("target_bytes", math.inf)
+    ]
+    if len(small) > 0:
+        best = min(small, key=lambda point: point["ms"])
+    else:
+        best = min(usable, key=lambda point: point["bytes"])
+    return (best["format"], best["args"])
+
+
+class AutoEncoders(object):
+    """Encoder choices for every auto setting, computed once
+    from a calibration file so choosing at request time is
+    a dictionary lookup
+
+    Args:
+        calibration_path (str): Path to the output of
+            calibrate(). If it doesn't exist, every auto setting
+            falls back to webp with the setting's args.
+        formats (Dict[str, List[dict]]): The contents
+            of formats.json.
+    """
+
+    def __init__(self, calibration_path: Optional[str], formats: Dict[str, List[dict]]):
+        curves: Dict[str, Dict[str, List[Dict[str, Any]]]] = {}
+        if calibration_path is not None and os.path.exists(calibration_path):
+            with open(calibration_path) as calibration_file:
+                curves = json.load(calibration_file)["curves"]
+
+        # (mode, setting index, class, bucket) -> encoder
+        self._choices: Dict[Tuple[str, int, str, int], Encoder] = {}
+        for mode, settings in formats.items():
+            for i, setting in enumerate(settings):
+                if setting["format"] != "auto":
+                    continue
+                for cls in ("opaque", "alpha"):
+                    for bucket in BUCKETS:
+                        choice = _choose(curves.get(cls, {}).get(str(bucket), []), setting)
+                        if choice is not None:
+                            self._choices[(mode, i, cls, bucket)] = choice
+
+    def get(
+        self,
+        mode: str, setting_index: int, setting: dict,
+        dim: int, fully_opaque: bool,
+    ) -> Encoder:
+        choice = self._choices.get((mode, setting_index, get_class(fully_opaque), get_bucket(dim)))
+        if choice is None:
+            return ("webp", setting.get("args", {}))
+        return choice
+
+    def get_choices(self, mode: str) -> List[Tuple[int, str, int, Encoder]]:
+        # (setting index, class, bucket, encoder) of every choice
+        # for the auto settings of mode, so renders can be
+        # matched to the calibration they were made with
+        return sorted(
+            (
+                (i, cls, bucket, choice)
+                for (choice_mode, i, cls, bucket), choice in self._choices.items()
+                if choice_mode == mode
+            ),
+            key=lambda choice: choice[:3],
+        )
+
+
+if __name__ == "__main__":
+    calibrate(
+        sys.argv[1], sys.argv[2],
+        *(int(arg) for arg in sys.argv[3:4]),
+    )
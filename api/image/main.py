@@ -2,19 +2,27 @@
 # discord-bot/cannedthighs/__init__.py and
 # discord-bot/cannedthighs/image_generator.py
 
+from concurrent import futures
+import contextlib
 import functools
+import hashlib
 import io
 import json
 import os
 import pathlib
 import random
-from typing import Any, Dict, List, Literal, Optional, Tuple
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple
 import urllib.parse
 
 import dotenv
-from flask import abort, Flask, redirect, request, make_response
+from flask import abort, Flask, jsonify, redirect, request, make_response
+import numpy as np
 from PIL import Image
 
+from api.image import cache, corpus, crops, encoders, metrics, store
+
 
 # loading config #################
 
@@ -24,19 +32,47 @@ dotenv.load_dotenv(".image.env")
 # Path to a folder containing all the images that
 # should be served
 IMAGE_PATH = os.getenv("IMAGE_PATH")
-if IMAGE_PATH is None:
+
+# PACK_PATH
+# Path to a folder containing a pack of the images
+# (see store.py). If set, images are memory-mapped from
+# the pack instead of being decoded from IMAGE_PATH, so
+# all workers share one copy of the pixels in memory.
+# tiled packs work too, but each image is decompressed
+# whole at startup, since the server keeps downscaled
+# copies of every image (tiles are meant for the bot)
+PACK_PATH = os.getenv("PACK_PATH")
+
+if IMAGE_PATH is None and PACK_PATH is None:
     raise RuntimeError("path to image data not specified")
 
 # FORMAT_PATH
 # The path to the json file containing image encoding
-# formats to use when sending images
+# formats to use when sending images. A setting can have
+# an "opaque" encoder, e.g.
+#   "opaque": {"format": "jpeg", "args": {"quality": 90}}
+# which is used instead of its own for crops without any
+# transparent pixels. formats without an alpha channel are
+# only valid for those crops
 # Default: formats.json (in current directory)
 _FormatName = str
-_FormatKeys = Literal["maxsize", "format", "reduce", "args"]
+_FormatKeys = Literal[
+    "maxsize", "format", "reduce", "args",
+    "target_bytes", "budget_ms", "min_psnr", "opaque",
+]
 _Format = List[Dict[_FormatKeys, Any]]
 with open(os.getenv("FORMAT_PATH", "formats.json")) as format_file:
     FILE_FORMATS: Dict[_FormatName, _Format] = json.load(format_file)
 
+# CALIBRATION_PATH
+# The path to the json file of encoder cost curves used
+# by formats with "format": "auto" (see encoders.py). If
+# the file doesn't exist, auto formats use the webp
+# arguments in their "args"
+# Default: calibration.json (in current directory)
+CALIBRATION_PATH = os.getenv("CALIBRATION_PATH", "calibration.json")
+AUTO_ENCODERS = encoders.AutoEncoders(CALIBRATION_PATH, FILE_FORMATS)
+
 # DEFAULT_FORMAT
 # The format from formats.json to use by default,
 # unless another is manually requested
@@ -50,7 +86,7 @@ DEFAULT_THRESHOLD = float(os.getenv("DEFAULT_THRESHOLD", "0.4"))
 # PADDING
 # The amount of empty space to ignore around each
 # image
-PADDING = int(os.getenv("PADDING", "40"))
+PADDING = int(os.getenv("PADDING", str(crops.DEFAULT_PADDING)))
 
 # MAX_SIZE_THRESHOLD
 # The maximum value of size*threshold a request can
@@ -63,25 +99,211 @@ PADDING = int(os.getenv("PADDING", "40"))
 # threshold
 MAX_SIZE_THRESHOLD = int(os.getenv("MAX_SIZE_THRESHOLD", "100"))
 
+# CENTER_STEP
+# The spacing in pixels between candidate center points
+# when precomputing which positions in an image pass the
+# opacity threshold. Larger values use less memory per
+# image but give fewer distinct starting positions
+CENTER_STEP = int(os.getenv("CENTER_STEP", str(crops.DEFAULT_CENTER_STEP)))
+
+# CACHE_SIZE
+# The maximum total size, in megabytes, of encoded
+# images kept in memory by each worker so repeated
+# requests for the same crop aren't encoded again.
+# Set to 0 to disable the in-memory cache
+CACHE_SIZE = float(os.getenv("CACHE_SIZE", "64"))
+
+# CACHE_REDIS_URL
+# If set, the url of a redis server used as a second
+# level image cache, shared between workers and servers,
+# e.g. redis://localhost:6379/0. While it can't be
+# reached, images are rendered as if it were empty
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL")
+
+# CACHE_REDIS_TTL
+# The number of seconds images are kept in the shared
+# redis cache
+CACHE_REDIS_TTL = int(os.getenv("CACHE_REDIS_TTL", "60"))
+
+# PRERENDER
+# If set to anything, /new starts encoding every step of
+# the new round in the background and stores them in the
+# image cache, so the following requests for each step
+# only read memory. Leave unset or set to an empty
+# string to only encode images when they are requested.
+# Prerendered images are only found by requests reading
+# the same cache: without CACHE_REDIS_URL that's only
+# requests handled by the same process (with several
+# gunicorn workers, most steps miss), and with no cache
+# at all (CACHE_SIZE=0 and no CACHE_REDIS_URL) nothing is
+# prerendered
+PRERENDER = os.getenv("PRERENDER", "") != ""
+if PRERENDER and CACHE_SIZE <= 0 and CACHE_REDIS_URL is None:
+    print("not prerendering, since there is no image cache to keep the images in")
+    PRERENDER = False
+elif PRERENDER and CACHE_REDIS_URL is None:
+    print("PRERENDER without CACHE_REDIS_URL only helps requests handled by the same worker")
+
+# PRERENDER_THREADS
+# The number of background threads per worker used to
+# encode images when PRERENDER is set
+PRERENDER_THREADS = int(os.getenv("PRERENDER_THREADS", "2"))
+
+# PYRAMID
+# If set to anything, keep downscaled copies of every
+# image for each reduce factor used in formats.json, so
+# large crops which get reduced are cut from a smaller
+# image instead of being cropped at full resolution and
+# reduced on every request. Uses about a third more
+# memory per image. Set to an empty string to disable
+# Default: enabled
+PYRAMID = os.getenv("PYRAMID", "1") != ""
+
+# SEEDED_POSITIONS
+# The number of distinct starting positions per image and
+# crop size that rounds with a seed are picked from, so
+# seeded rounds keep hitting the same crops in the image
+# caches. Unseeded rounds use every valid position
+SEEDED_POSITIONS = int(os.getenv("SEEDED_POSITIONS", "32"))
+
+# CORPUS_PATH
+# Path to a folder of pre-rendered images made by
+# gamedata/render_corpus.py. Images in it are read from
+# disk instead of being rendered; anything else (including
+# renders of images or formats which changed since it was
+# built) is rendered as usual
+CORPUS_PATH = os.getenv("CORPUS_PATH")
+
+# ANALYSIS_PATH
+# The path to an index made by gamedata/image_analysis.py.
+# If set, the charset and difficulty of /new and /round
+# choose which images can be picked, from the buckets in
+# the index. Otherwise both are ignored and any image can
+# be picked
+ANALYSIS_PATH = os.getenv("ANALYSIS_PATH")
+
+# METRICS_DIR
+# A directory where each worker process writes its
+# counters for /metrics, so /metrics shows the totals of
+# every gunicorn worker whichever one answers it. Should
+# be emptied before starting the server (e.g. a tmpfs).
+# If unset, /metrics only shows the worker answering it
+METRICS_DIR = os.getenv("METRICS_DIR")
+
+# SLOW_RENDER_MS
+# If set, every render taking longer than this many
+# milliseconds is printed with its image, rect and format
+# tier, to find which images make rounds slow (too many
+# to be histogram labels)
+SLOW_RENDER_MS = float(os.getenv("SLOW_RENDER_MS", "0"))
+
 
 # setup stuff ####################
 
 app = Flask(__name__)
 images: Dict[str, Image.Image] = {}
+# summed-area tables of fully opaque pixels, see
+# crops.get_opaque_table
+opaque_tables: Dict[str, np.ndarray] = {}
+# downscaled copies of images, by reduce factor
+pyramids: Dict[str, Dict[int, Image.Image]] = {}
 char_ids: List[str] = []
+# changes whenever an image does, see get_image_hash
+image_hashes: Dict[str, str] = {}
+
+# every reduce factor which can be applied to a crop
+PYRAMID_FACTORS = sorted({
+    setting["reduce"]
+    for settings in FILE_FORMATS.values()
+    for setting in settings
+    if setting["reduce"] > 1
+}) if PYRAMID else []
+
+
+center_indexes: Dict[Tuple[str, int, float], crops.CenterIndex] = {}
+
+# used by rounds without a seed
+unseeded_rng = random.Random()
 
-for path in pathlib.Path(IMAGE_PATH).iterdir():
-    if not path.is_file():
-        continue
-    name = path.stem  # remove the extension
-    images[name] = Image.open(path)
-    char_ids.append(name)
-    if app.env == "production":
-        images[name].load()
+image_cache: cache.ImageCache = (
+    cache.MemoryCache(int(CACHE_SIZE*1000000))
+    if CACHE_SIZE > 0
+    else cache.NullCache()
+)
+if CACHE_REDIS_URL is not None:
+    image_cache = cache.TieredCache(
+        image_cache,
+        cache.RedisCache(CACHE_REDIS_URL, CACHE_REDIS_TTL),
+    )
+
+# images currently being encoded in the background, so a
+# request arriving mid-encode waits instead of encoding
+# the same image again
+pending_renders: Dict[str, "futures.Future[cache.CacheEntry]"] = {}
+pending_lock = threading.Lock()
+prerender_pool: Optional[futures.ThreadPoolExecutor] = (
+    futures.ThreadPoolExecutor(PRERENDER_THREADS, "prerender")
+    if PRERENDER
+    else None
+)
+
+
+# timing ##########################
+
+# phase -> total ms spent in it by the current request, if
+# it's being timed. thread local, since each sync worker
+# thread handles one request at a time (renders on the
+# prerender threads aren't part of any request)
+_request_timings = threading.local()
+
+# every phase passed to _timed
+PHASES = ("opacity", "position", "crop", "reduce", "encode", "wait", "corpus")
+# routes timed by REQUEST_SECONDS
+ROUTES = ("/new", "/round", "/<char_id>")
+
+metrics_registry = metrics.Registry(METRICS_DIR)
+PHASE_SECONDS = metrics.Histogram(
+    metrics_registry, "image_phase_seconds",
+    "Time spent in each phase of making images, including prerendering",
+    ("phase",), [(phase,) for phase in PHASES],
+    metrics.SECONDS_BUCKETS,
+)
+REQUEST_SECONDS = metrics.Histogram(
+    metrics_registry, "image_request_seconds",
+    "Time taken to answer requests, by route",
+    ("route",), [(route,) for route in ROUTES],
+    metrics.SECONDS_BUCKETS,
+)
+IMAGE_BYTES = metrics.Histogram(
+    metrics_registry, "image_encoded_bytes",
+    "Size of encoded images, by formats.json mode and tier (index in the mode)",
+    ("mode", "tier"), metrics.tier_labels(FILE_FORMATS),
+    metrics.BYTES_BUCKETS,
+)
+
+
+@contextlib.contextmanager
+def _timed(phase: str) -> Iterator[None]:
+    s = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        e = time.perf_counter_ns()
+        PHASE_SECONDS.observe((phase,), (e-s)/1000000000)
+        timings: Optional[Dict[str, float]] = getattr(_request_timings, "phases", None)
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0) + (e-s)/1000000
 
 
 # image processing functions #####
 
+def get_opaque_table(char_id: str) -> np.ndarray:
+    table = opaque_tables.get(char_id)
+    if table is None:
+        table = crops.get_opaque_table(images[char_id])
+        opaque_tables[char_id] = table
+    return table
+
 def _clamp(x, start, end):
     # note, if end < start, returns start
     return max(min(x, end), start)
@@ -105,29 +327,117 @@ def _center_and_nudge(
     return (x, y, x+w, y+h)
 
 
-def _get_opaque_percentage(im: Image.Image) -> float:
-    return (
-        # count the number of fully opaque pixels
-        im.getchannel("A").histogram()[255]
-        # divide by total number of pixels
-        / (im.width*im.height)
+def get_center_index(char_id: str, size: int, threshold: float) -> crops.CenterIndex:
+    key = (char_id, size, threshold)
+    index = center_indexes.get(key)
+    if index is None:
+        with _timed("opacity"):
+            index = crops.get_center_index(
+                get_opaque_table(char_id), size, threshold,
+                PADDING, CENTER_STEP,
+            )
+        center_indexes[key] = index
+    return index
+
+
+def get_pyramid_level(char_id: str, reduce: int) -> Image.Image:
+    levels = pyramids.setdefault(char_id, {})
+    level = levels.get(reduce)
+    if level is None:
+        with _timed("reduce"):
+            level = images[char_id].reduce(reduce)
+        levels[reduce] = level
+    return level
+
+
+def _align_rect(
+    char_id: str,
+    rect: Tuple[int, int, int, int],
+    reduce: int,
+) -> Tuple[int, int, int, int]:
+    # moves rect (by less than reduce pixels) to start at a
+    # multiple of reduce and end at one or at the edge of
+    # the image, keeping the size of its reduced crop. the
+    # crop then covers whole blocks of the pyramid level, so
+    # cutting it from the level gives exactly the pixels of
+    # im.crop(rect).reduce(reduce), with or without PYRAMID
+    if reduce <= 1:
+        return rect
+    im = images[char_id]
+    x0, y0, x1, y1 = rect
+    width = -(-(x1-x0)//reduce)
+    height = -(-(y1-y0)//reduce)
+    x = _clamp(x0//reduce, 0, -(-im.width//reduce)-width)*reduce
+    y = _clamp(y0//reduce, 0, -(-im.height//reduce)-height)*reduce
+    return (x, y, min(x+width*reduce, im.width), min(y+height*reduce, im.height))
+
+
+def _crop(
+    char_id: str,
+    rect: Tuple[int, int, int, int],
+    reduce: int,
+) -> Image.Image:
+    # rect must come from _align_rect
+    if reduce <= 1:
+        with _timed("crop"):
+            return images[char_id].crop(rect)
+    if reduce not in PYRAMID_FACTORS:
+        with _timed("crop"):
+            im = images[char_id].crop(rect)
+        with _timed("reduce"):
+            return im.reduce(reduce)
+
+    # cut the same blocks out of the downscaled image
+    level = get_pyramid_level(char_id, reduce)
+    x0, y0, x1, y1 = rect
+    with _timed("crop"):
+        return level.crop((x0//reduce, y0//reduce, -(-x1//reduce), -(-y1//reduce)))
+
+
+def _is_fully_opaque(char_id: str, rect: Tuple[int, int, int, int]) -> bool:
+    table = get_opaque_table(char_id)
+    x0, y0, x1, y1 = rect
+    count = (
+        table.item(y1, x1) - table.item(y0, x1)
+        - table.item(y1, x0) + table.item(y0, x0)
     )
+    return count == (x1-x0)*(y1-y0)
 
 
-def _get_byte_stream(im: Image.Image, mode: str) -> Tuple[io.BytesIO, str]:
+def _get_byte_stream(
+    char_id: str,
+    rect: Tuple[int, int, int, int],
+    mode: str,
+) -> Tuple[io.BytesIO, str]:
     render_settings = FILE_FORMATS[mode]
 
     img_buf = io.BytesIO(b"")
-    dim = max(im.width, im.height)
+    dim = max(rect[2]-rect[0], rect[3]-rect[1])
 
-    for setting in render_settings:
+    s = time.perf_counter_ns()
+    for i, setting in enumerate(render_settings):
         size = setting["maxsize"]
         if size == -1 or dim < size:
-            reduce = setting["reduce"]
-            if reduce > 1:
-                im = im.reduce(reduce)
-            im.save(img_buf, setting["format"], **setting["args"])
-            format_used = setting["format"]
+            crop_rect = _align_rect(char_id, rect, setting["reduce"])
+            im = _crop(char_id, crop_rect, setting["reduce"])
+            # from the summed-area table, so no pixels are read
+            fully_opaque = _is_fully_opaque(char_id, crop_rect)
+            with _timed("encode"):
+                if setting["format"] == "auto":
+                    encoder = AUTO_ENCODERS.get(
+                        mode, i, setting,
+                        max(im.width, im.height),
+                        fully_opaque,
+                    )
+                else:
+                    encoder = (setting["format"], setting["args"])
+
+                if fully_opaque and "opaque" in setting:
+                    # no alpha to keep, so formats without
+                    # it can be used. (webp already leaves
+                    # out an alpha plane which is all opaque)
+                    encoder = (setting["opaque"]["format"], setting["opaque"]["args"])
+                format_used = encoders.encode(im, encoder, img_buf)
             break
     else:
         # else of for loop is executed when loop
@@ -136,14 +446,120 @@ def _get_byte_stream(im: Image.Image, mode: str) -> Tuple[io.BytesIO, str]:
         print("no appropriate setting was found (didn't end format list with maxsize: -1?)")
         # default to this so at least *some* image
         # comes out, even if it's not intended
+        im = _crop(char_id, rect, 1)
         im.save(img_buf, "webp", lossless=False, quality=70, method=0)
         format_used = "webp"
+        i = -1
+
+    ms = (time.perf_counter_ns()-s)/1000000
+    IMAGE_BYTES.observe((mode, str(i)), img_buf.tell())
+    if SLOW_RENDER_MS > 0 and ms > SLOW_RENDER_MS:
+        print(f"slow render: {char_id} {rect} {mode} tier {i} ({format_used}, {img_buf.tell()} bytes) in {ms:.1f}ms")
 
     img_buf.flush()
     img_buf.seek(0)
     return (img_buf, format_used)
 
 
+def _hash_pixels(im: Image.Image) -> str:
+    digest = hashlib.sha256(f"{im.mode} {im.width} {im.height}".encode())
+    digest.update(im.tobytes())
+    return digest.hexdigest()
+
+
+if PACK_PATH is not None:
+    pack = store.Pack(PACK_PATH)
+    for name in pack.entries:
+        # already decoded, so there's nothing to load
+        images[name] = pack.image(name)
+        char_ids.append(name)
+        # packs from image_formatter.py and store.py record
+        # a hash of each image, only older ones need hashing
+        image_hashes[name] = pack.entries[name].get("hash") or _hash_pixels(images[name])
+        # packs from image_formatter.py come with tables
+        table = pack.opaque_table(name)
+        if table is not None:
+            opaque_tables[name] = table
+        elif app.env == "production":
+            get_opaque_table(name)
+        if app.env == "production":
+            for factor in PYRAMID_FACTORS:
+                get_pyramid_level(name, factor)
+else:
+    # one of the paths is required, see PACK_PATH
+    assert IMAGE_PATH is not None
+    for path in pathlib.Path(IMAGE_PATH).iterdir():
+        if not path.is_file():
+            continue
+        name = path.stem  # remove the extension
+        images[name] = Image.open(path)
+        char_ids.append(name)
+        # same as the hashes of store.build, without reading
+        # the file, so copying the folder counts as a change
+        stat = path.stat()
+        image_hashes[name] = f"{stat.st_mtime_ns}:{stat.st_size}"
+        if app.env == "production":
+            images[name].load()
+            get_opaque_table(name)
+            for factor in PYRAMID_FACTORS:
+                get_pyramid_level(name, factor)
+
+
+# sorted so seeded rounds pick the same images on every
+# server, whatever order the files were listed in
+char_ids.sort()
+
+# charset -> difficulty -> char_ids which can be picked,
+# see gamedata/image_analysis.py
+char_id_buckets: Optional[List[List[List[str]]]] = None
+if ANALYSIS_PATH is not None:
+    with open(ANALYSIS_PATH, encoding="utf-8") as analysis_file:
+        analysis = json.load(analysis_file)
+    if analysis["version"] != 1:
+        raise RuntimeError(f"unsupported analysis version {analysis['version']}")
+    if analysis["threshold"] != DEFAULT_THRESHOLD:
+        print(
+            f"analysis was made with threshold {analysis['threshold']}"
+            f" but DEFAULT_THRESHOLD is {DEFAULT_THRESHOLD}"
+        )
+    if analysis["padding"] != PADDING or analysis["center_step"] != CENTER_STEP:
+        print(
+            f"analysis was made with padding {analysis['padding']} and center step"
+            f" {analysis['center_step']} but PADDING is {PADDING} and CENTER_STEP is {CENTER_STEP}"
+        )
+    # images which aren't served can't be picked
+    char_id_buckets = [
+        [[name for name in bucket if name in images] for bucket in levels]
+        for levels in analysis["buckets"]
+    ]
+    del analysis
+
+
+def get_image_hash(char_id: str) -> str:
+    # changes whenever the image does, so a corpus isn't used
+    # for an image which was reformatted since it was built.
+    # recorded when the images are loaded, see image_hashes
+    return image_hashes[char_id]
+
+
+def get_format_fingerprint(mode: str) -> str:
+    # the settings of a formats.json mode and the encoders
+    # CALIBRATION_PATH picked for its auto tiers, which
+    # together decide what its renders look like
+    return corpus.get_fingerprint(FILE_FORMATS[mode], AUTO_ENCODERS.get_choices(mode))
+
+
+corpus_index: Optional[corpus.Corpus] = (
+    corpus.Corpus(
+        CORPUS_PATH,
+        {mode: get_format_fingerprint(mode) for mode in FILE_FORMATS},
+        get_image_hash,
+    )
+    if CORPUS_PATH is not None
+    else None
+)
+
+
 # fun decorators #################
 
 def add_img_from_id(route_handler):
@@ -192,49 +608,175 @@ def convert_args(**arguments):
 
 # flask stuff ####################
 
-def generate(im: Image.Image, x: int, y: int, size: int, mode: str):
-    cropped = im.crop(_center_and_nudge(x, y, size, im.width, im.height))
-    return _get_byte_stream(cropped, mode)
-
-
-def generate_new(im: Image.Image, size: int, threshold: float, mode: str):
-    num_attempts = 0
-    x_padding = PADDING
-
-    while True:
-        x = random.randint(x_padding, im.width-1-x_padding)
-        y = random.randint(PADDING, im.height-1-PADDING)
+@app.before_request
+def _start_timing():
+    _request_timings.phases = {}
+    _request_timings.start = time.perf_counter_ns()
+
+
+@app.after_request
+def _add_server_timing(res):
+    # phases of the request as a Server-Timing header, e.g.
+    # for browser dev tools and api/image/bench.py
+    timings: Optional[Dict[str, float]] = getattr(_request_timings, "phases", None)
+    _request_timings.phases = None
+    if request.url_rule is not None:
+        REQUEST_SECONDS.observe(
+            (request.url_rule.rule,),
+            (time.perf_counter_ns()-_request_timings.start)/1000000000,
+        )
+    if timings:
+        res.headers["Server-Timing"] = ", ".join(
+            f"{phase};dur={ms:.3f}" for phase, ms in timings.items()
+        )
+    return res
 
-        cropped = im.crop(_center_and_nudge(x, y, size, im.width, im.height))
-        percentage = _get_opaque_percentage(cropped)
-        if percentage >= threshold:
-            break
 
-        num_attempts += 1
-        if num_attempts > 150:
-            # after 150 failed attempts we can be pretty
-            # sure the query is impossible to serve, but
-            # theoretically it might still be possible.
-            # maybe code 500 should be used instead
-            # because it is possible the request would
-            # succeed if sent again, unmodified, but the
-            # chance is so low the arguments should
-            # probably be adjusted
-            abort(422)
-        elif num_attempts > 5:
-            x_padding = min(x_padding + PADDING//2, int(im.width*0.4))
+def _get_cache_key(
+    char_id: str,
+    rect: Tuple[int, int, int, int],
+    mode: str,
+) -> str:
+    # use the rect rather than the requested position so
+    # positions which get nudged to the same crop share
+    # an entry
+    return f"{char_id}:{','.join(map(str, rect))}:{mode}"
+
+
+def _render(
+    char_id: str,
+    rect: Tuple[int, int, int, int],
+    mode: str,
+    key: str,
+) -> cache.CacheEntry:
+    stream, format = _get_byte_stream(char_id, rect, mode)
+    entry = (stream.getvalue(), format)
+    image_cache.put(key, entry)
+    return entry
+
+
+def _prerender(
+    char_id: str,
+    rect: Tuple[int, int, int, int],
+    mode: str,
+    key: str,
+) -> cache.CacheEntry:
+    try:
+        return _render(char_id, rect, mode, key)
+    finally:
+        with pending_lock:
+            del pending_renders[key]
+
+
+def get_corpus_file(char_id: str, x: int, y: int, size: int, mode: str) -> Optional[corpus.CorpusFile]:
+    if corpus_index is None:
+        return None
+    im = images[char_id]
+    rect = _center_and_nudge(x, y, size, im.width, im.height)
+    return corpus_index.get(_get_cache_key(char_id, rect, mode))
+
+
+def generate(char_id: str, x: int, y: int, size: int, mode: str) -> cache.CacheEntry:
+    im = images[char_id]
+    rect = _center_and_nudge(x, y, size, im.width, im.height)
+    key = _get_cache_key(char_id, rect, mode)
+
+    entry = image_cache.get(key)
+    if entry is not None:
+        return entry
+
+    # not cached, since the page cache already keeps the
+    # popular files in memory
+    if corpus_index is not None:
+        corpus_file = corpus_index.get(key)
+        if corpus_file is not None:
+            with _timed("corpus"):
+                return (corpus_index.read(corpus_file), corpus_file[1])
+
+    with pending_lock:
+        future = pending_renders.get(key)
+    if future is not None:
+        # being rendered by a prerender thread
+        with _timed("wait"):
+            return future.result()
+
+    return _render(char_id, rect, mode, key)
+
+
+def prerender(char_id: str, x: int, y: int, difficulty: int, mode: str) -> None:
+    # encode every step of a round in the background,
+    # skipping any images which are already available
+    if prerender_pool is None:
+        return
+
+    im = images[char_id]
+    for step in range(crops.LAST_STEP+1):
+        rect = _center_and_nudge(
+            x, y, crops.get_size(step, difficulty),
+            im.width, im.height,
+        )
+        key = _get_cache_key(char_id, rect, mode)
+        if corpus_index is not None and corpus_index.get(key) is not None:
+            continue
+        # checked outside the lock, since a shared cache is
+        # a network request
+        if key in image_cache:
+            continue
+        with pending_lock:
+            if key in pending_renders:
+                continue
+            pending_renders[key] = prerender_pool.submit(
+                _prerender, char_id, rect, mode, key,
+            )
+
+
+def get_round_rng(seed: str, charset: int, difficulty: int) -> random.Random:
+    # a round with a seed is the same for every request
+    # with the same seed, charset and difficulty (on every
+    # server with the same images), so it can be replayed
+    # and its images are shared between games in caches.
+    # str seeds are hashed with sha512, not hash(), so they
+    # don't change between processes
+    if seed == "":
+        return unseeded_rng
+    return random.Random(f"{seed}:{charset}:{difficulty}")
+
+
+def get_new_position(index: crops.CenterIndex, rng: random.Random) -> Tuple[int, int]:
+    # only searches the precomputed opacity index: nothing is
+    # decoded or encoded, so new rounds are cheap to start
+    if len(index.valid) == 0:
+        # no position in the image has enough opaque
+        # pixels, so the request can never succeed
+        abort(422)
 
-    return (x, y, *_get_byte_stream(cropped, mode))
+    with _timed("position"):
+        if rng is unseeded_rng:
+            i = int(index.valid[rng.randrange(len(index.valid))])
+            y_index, x_index = divmod(i, len(index.xs))
+            return (int(index.xs[x_index]), int(index.ys[y_index]))
+        positions = get_seeded_positions(index)
+        return positions[rng.randrange(len(positions))]
 
 
-def get_size(step: int, difficulty: int) -> int:
-    # todo: use difficulty
-    return (9*step + 34)*step + 69
+def get_seeded_positions(index: crops.CenterIndex) -> List[Tuple[int, int]]:
+    # evenly spaced subset of the valid positions, the same
+    # for every seed (and the ones in the corpus)
+    valid = index.valid[::max(1, -(-len(index.valid)//SEEDED_POSITIONS))]
+    y_indices, x_indices = np.divmod(valid, len(index.xs))
+    return list(zip(index.xs[x_indices].tolist(), index.ys[y_indices].tolist()))
 
 
-def get_random_char_id(charset: int) -> str:
-    # todo: use charset
-    return random.choice(char_ids)
+def get_random_char_id(charset: int, difficulty: int, rng: random.Random) -> Optional[str]:
+    # None if no image has that charset and difficulty
+    if char_id_buckets is None:
+        return rng.choice(char_ids)
+    if not 0 <= charset < len(char_id_buckets):
+        return None
+    levels = char_id_buckets[charset]
+    if not 0 <= difficulty < len(levels) or len(levels[difficulty]) == 0:
+        return None
+    return rng.choice(levels[difficulty])
 
 
 def get_link(
@@ -261,8 +803,9 @@ def make_link_header(
     difficulty=(int, 0),
     charset=(int, 0),
     mode=(str, DEFAULT_FORMAT),
+    seed=(str, ""),
 )
-def get_random_new(difficulty: int, charset: int, mode: str):
+def get_random_new(difficulty: int, charset: int, mode: str, seed: str):
     if mode not in FILE_FORMATS:
         abort(422)
 
@@ -272,10 +815,18 @@ def get_random_new(difficulty: int, charset: int, mode: str):
     # if threshold*size > MAX_SIZE_THRESHOLD:
     #     abort(422)
 
-    char_id = get_random_char_id(charset)
-    x, y, stream, format = generate_new(
-        images[char_id], get_size(0, difficulty), DEFAULT_THRESHOLD, mode,
+    rng = get_round_rng(seed, charset, difficulty)
+    char_id = get_random_char_id(charset, difficulty, rng)
+    if char_id is None:
+        abort(422)
+    x, y = get_new_position(
+        get_center_index(char_id, crops.get_size(0, difficulty), DEFAULT_THRESHOLD),
+        rng,
     )
+    # the redirect doesn't need any image, so encoding is
+    # left to the prerender threads (if enabled) or the
+    # first request for each step
+    prerender(char_id, x, y, difficulty, mode)
 
     return redirect(
         get_link(char_id, x, y, 0, difficulty, mode),
@@ -295,27 +846,100 @@ def generate_handler(
 ):
     if mode not in FILE_FORMATS:
         abort(422)
-    size = get_size(step, difficulty)
+    size = crops.get_size(step, difficulty)
     if size < 1:
         abort(422)
 
     if request.method != "HEAD":
-        stream, format = generate(im, x, y, size, mode)
-        res = make_response(stream.getvalue())
+        data, format = generate(char_id, x, y, size, mode)
+        res = make_response(data)
+        res.headers["Content-Type"] = f"image/{format}"
+    else:
         # can't really know the image type without knowing
         # what format was used on the resulting image but
         # we don't want to compute the image and we really
-        # only need the Link header so...
-        res.headers["Content-Type"] = f"image/{format}"
-    else:
+        # only need the Link header so... HEAD is only
+        # argument checks and arithmetic, no pillow
         res = make_response()
 
-    if step < 5:  # todo: use difficulty
+    if step < crops.LAST_STEP:
         res.headers["Link"] = make_link_header(char_id, x, y, step+1, difficulty, mode)
     return res
     # return send_file(stream, mimetype=f"image/{format}")
     # return _get_bytes(cropped, mode)
 
 
+def _encode_round(metadata: Dict[str, Any], data: List[bytes]) -> bytes:
+    # length-prefixed so clients don't need a multipart
+    # parser: the length of the json as a 4 byte big endian
+    # int, the json, then each step's image one after the
+    # other (the json has each image's length)
+    header = json.dumps(metadata).encode()
+    return b"".join((len(header).to_bytes(4, "big"), header, *data))
+
+
+@app.route("/round", methods=["GET"])
+@convert_args(
+    difficulty=(int, 0),
+    charset=(int, 0),
+    mode=(str, DEFAULT_FORMAT),
+    send_images=(int, 1),
+    seed=(str, ""),
+)
+def get_round(difficulty: int, charset: int, mode: str, send_images: int, seed: str):
+    # everything /new and following every Link would give,
+    # in one response. with send_images=0, only the json is sent
+    # (e.g. to warm caches without downloading anything).
+    # with a seed, the same round is returned every time
+    if mode not in FILE_FORMATS:
+        abort(422)
+
+    rng = get_round_rng(seed, charset, difficulty)
+    char_id = get_random_char_id(charset, difficulty, rng)
+    if char_id is None:
+        abort(422)
+    x, y = get_new_position(
+        get_center_index(char_id, crops.get_size(0, difficulty), DEFAULT_THRESHOLD),
+        rng,
+    )
+    # render the steps in parallel, if possible
+    prerender(char_id, x, y, difficulty, mode)
+
+    steps: List[Dict[str, Any]] = []
+    data: List[bytes] = []
+    for step in range(crops.LAST_STEP+1):
+        step_data, format = generate(char_id, x, y, crops.get_size(step, difficulty), mode)
+        steps.append({
+            "link": get_link(char_id, x, y, step, difficulty, mode),
+            "format": format,
+            "length": len(step_data) if send_images else 0,
+        })
+        if send_images:
+            data.append(step_data)
+
+    res = make_response(_encode_round({
+        "char_id": char_id,
+        "x": x,
+        "y": y,
+        "difficulty": difficulty,
+        "mode": mode,
+        "steps": steps,
+    }, data))
+    res.headers["Content-Type"] = "application/octet-stream"
+    return res
+
+
+@app.route("/cache", methods=["GET"])
+def cache_stats():
+    return jsonify(image_cache.stats())
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_handler():
+    res = make_response(metrics_registry.expose())
+    res.headers["Content-Type"] = "text/plain; version=0.0.4"
+    return res
+
+
 if __name__ == "__main__":
     app.run(host="localhost", port=5000, debug=True)
@@ -0,0 +1,190 @@
+# prometheus-style histograms for the image server, without
+# a client library. every label combination is known when
+# the server starts (phases, formats.json tiers), so each
+# histogram is a fixed block of counters, and the counters
+# of all the histograms are one flat float64 array
+#
+# gunicorn workers are separate processes, so for /metrics
+# to show every worker's data each process writes its
+# counters to a memory-mapped file of its own in a shared
+# directory, and /metrics sums the files. a file only has
+# one writing process, so no locks are needed across
+# processes. files of workers which exited are kept, so
+# counters never go down while the server runs (empty the
+# directory when starting the server)
+
+import bisect
+import os
+import pathlib
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# label values, in the same order as the label names
+_Labels = Tuple[str, ...]
+
+
+class Histogram(object):
+    """One prometheus histogram with a fixed set of label values
+
+    Args:
+        registry (Registry): Where its counters are stored.
+        name (str): The metric name.
+        help (str): The metric description.
+        label_names (Sequence[str]): The name of each label.
+        label_values (Sequence[_Labels]): Every combination of label
+            values which can be observed.
+        buckets (Sequence[float]): Upper bounds of the buckets, in
+            increasing order. A +Inf bucket is added.
+    """
+
+    def __init__(
+        self,
+        registry: "Registry",
+        name: str,
+        help: str,
+        label_names: Sequence[str],
+        label_values: Sequence[_Labels],
+        buckets: Sequence[float],
+    ):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.buckets = list(buckets)
+        self._rows = {labels: i for i, labels in enumerate(label_values)}
+        # each row: one count per bucket (not cumulative),
+        # the +Inf bucket, then the sum
+        self._width = len(self.buckets)+2
+        self._offset = registry._add(self, len(self._rows)*self._width)
+        self._registry = registry
+
+    def _row(self, labels: _Labels) -> int:
+        return self._offset + self._rows[labels]*self._width
+
+    def observe(self, labels: _Labels, value: float) -> None:
+        # unknown labels are ignored rather than failing the
+        # request they're measuring
+        if labels not in self._rows:
+            return
+        row = self._row(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._registry._lock:
+            counters = self._registry._get_counters()
+            counters[row+bucket] += 1
+            counters[row+self._width-1] += value
+
+    def expose(self, counters: np.ndarray) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} histogram",
+        ]
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        for labels in self._rows:
+            row = self._row(labels)
+            label_text = ",".join(
+                f'{name}="{value}"'
+                for name, value in zip(self.label_names, labels)
+            )
+            prefix = label_text + "," if label_text else ""
+            label_text = f"{{{label_text}}}" if label_text else ""
+            total = 0
+            for i, bound in enumerate(bounds):
+                total += int(counters[row+i])
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {total}')
+            lines.append(f"{self.name}_sum{label_text} {float(counters[row+self._width-1])}")
+            lines.append(f"{self.name}_count{label_text} {total}")
+        return lines
+
+
+class Registry(object):
+    """The counters of every histogram, shared between processes
+    through files in a directory, if given
+
+    Args:
+        directory (Optional[str]): The directory each process writes
+            its counters to. If None, counters are kept in memory and
+            only cover the current process.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self._directory = None if directory is None else pathlib.Path(directory)
+        self._histograms: List[Histogram] = []
+        self._size = 0
+        self._lock = threading.Lock()
+        # the process the counters belong to, since a fork
+        # (e.g. gunicorn --preload) must not keep writing to
+        # its parent's file
+        self._pid: Optional[int] = None
+        self._counters: Optional[np.ndarray] = None
+
+    def _add(self, histogram: Histogram, size: int) -> int:
+        if self._counters is not None:
+            raise RuntimeError("histograms must be created before anything is observed")
+        offset = self._size
+        self._histograms.append(histogram)
+        self._size += size
+        return offset
+
+    def _get_counters(self) -> np.ndarray:
+        # called with the lock held
+        pid = os.getpid()
+        if self._counters is None or self._pid != pid:
+            self._pid = pid
+            if self._directory is None:
+                self._counters = np.zeros(self._size, dtype=np.float64)
+            else:
+                self._directory.mkdir(parents=True, exist_ok=True)
+                self._counters = np.memmap(
+                    self._directory / f"{pid}.metrics",
+                    dtype=np.float64, mode="w+", shape=(self._size,),
+                )
+        return self._counters
+
+    def collect(self) -> np.ndarray:
+        # the sum of every process's counters
+        with self._lock:
+            # also creates this process's file if needed
+            counters = self._get_counters()
+            if self._directory is None:
+                return counters.copy()
+
+        total = np.zeros(self._size, dtype=np.float64)
+        for path in self._directory.glob("*.metrics"):
+            counters = np.fromfile(path, dtype=np.float64)
+            # a file from a server with other formats or
+            # histograms can't be added up, so it's skipped
+            if counters.shape == total.shape:
+                total += counters
+        return total
+
+    def expose(self) -> str:
+        counters = self.collect()
+        lines: List[str] = []
+        for histogram in self._histograms:
+            lines.extend(histogram.expose(counters))
+        return "\n".join(lines) + "\n"
+
+
+# bucket bounds in seconds, from half a millisecond (cache
+# hits, small crops) to a few seconds (slow encoders)
+SECONDS_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+)
+
+# bucket bounds in bytes, from tiny first steps to the
+# largest lossless crops
+BYTES_BUCKETS = (
+    1000, 2000, 5000, 10000, 20000, 50000,
+    100000, 200000, 500000, 1000000, 2000000,
+)
+
+
+def tier_labels(formats: Dict[str, List[dict]]) -> List[_Labels]:
+    # (mode, tier index) of every setting in formats.json
+    return [
+        (mode, str(i))
+        for mode, settings in formats.items()
+        for i in range(len(settings))
+    ]
@@ -0,0 +1,212 @@
+# packed image store: every image decoded once, ahead of
+# time, into one file of raw RGBA pixels which each worker
+# memory-maps. the pages are shared between all processes
+# mapping the file, so running more workers doesn't use
+# more memory for images, and starting a worker doesn't
+# decode anything
+#
+# layout of a pack folder:
+#   pixels.bin: raw RGBA rows of every image, each image
+#     starting at a multiple of ALIGNMENT bytes
+#   tiles.bin (instead of pixels.bin, in tiled packs): every
+#     image split into tile_size x tile_size tiles (smaller at
+#     the right and bottom edges), in rows from the top left,
+#     each zlib compressed raw RGBA rows. fully transparent
+#     tiles are empty. a crop only decompresses the tiles it
+#     overlaps, so it doesn't need the whole image in memory
+#   opaque.bin (optional): summed-area tables of fully
+#     opaque pixels (see crops.get_opaque_table) as
+#     little-endian uint32, also aligned
+#   index.json: {
+#     "version": 1,
+#     "tile_size" (tiled packs only): int,
+#     "images": {
+#       name (file name without extension): {
+#         "file": original file name,
+#         "offset": byte offset into pixels.bin,
+#         "tile_offsets" (instead of offset, in tiled packs):
+#           byte offsets into tiles.bin of every tile, plus
+#           the end of the last tile,
+#         "width": int,
+#         "height": int,
+#         "opaque_offset" (optional): byte offset into opaque.bin,
+#         "bounds" (optional): the rect of the source image
+#           the image was cropped from,
+#         "hash" (optional): changes whenever the image does,
+#           so readers can tell which images were updated
+#       }, ...
+#     }
+#   }
+#
+# example usage (build a pack from a folder of images):
+# $ python -m api.image.store "images" "images-pack"
+# (gamedata/image_formatter.py builds packs as part of
+# formatting images, including tiled packs with --tiles)
+
+import json
+import mmap
+import os
+import pathlib
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+import zlib
+
+import numpy as np
+from PIL import Image
+
+
+VERSION = 1
+ALIGNMENT = 64
+TILE_SIZE = 128
+
+PIXELS_FILE = "pixels.bin"
+TILES_FILE = "tiles.bin"
+OPAQUE_FILE = "opaque.bin"
+INDEX_FILE = "index.json"
+
+
+def _align(offset: int) -> int:
+    return -(-offset//ALIGNMENT)*ALIGNMENT
+
+
+def build(image_path: str, pack_path: str) -> None:
+    os.makedirs(pack_path, exist_ok=True)
+    entries: Dict[str, Dict[str, Any]] = {}
+
+    with open(os.path.join(pack_path, PIXELS_FILE), "wb") as pixels:
+        for path in sorted(pathlib.Path(image_path).iterdir()):
+            if not path.is_file():
+                continue
+
+            with Image.open(path) as im:
+                data = im.convert("RGBA").tobytes()
+                width, height = im.size
+
+            offset = _align(pixels.tell())
+            pixels.seek(offset)
+            pixels.write(data)
+            stat = path.stat()
+            entries[path.stem] = {
+                "file": path.name,
+                "hash": f"{stat.st_mtime_ns}:{stat.st_size}",
+                "offset": offset,
+                "width": width,
+                "height": height,
+            }
+            print(f"packed {path.name}")
+
+    # write the index last so a partially written
+    # pack is never picked up
+    with open(os.path.join(pack_path, INDEX_FILE), "w") as index_file:
+        json.dump({"version": VERSION, "images": entries}, index_file)
+    print(f"{len(entries)} images packed")
+
+
+def _map_file(path: str) -> Optional[mmap.mmap]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _crop_tiles(
+    tiles: mmap.mmap, offsets: List[int], tile_size: int,
+    width: int, height: int,
+    rect: Tuple[int, int, int, int],
+) -> Image.Image:
+    x0, y0, x1, y1 = rect
+    # like Image.crop, anything outside the image is transparent
+    out = np.zeros((y1-y0, x1-x0, 4), dtype=np.uint8)
+    columns = -(-width//tile_size)
+
+    for ty in range(max(y0, 0)//tile_size, -(-min(y1, height)//tile_size)):
+        for tx in range(max(x0, 0)//tile_size, -(-min(x1, width)//tile_size)):
+            i = ty*columns + tx
+            start, end = offsets[i], offsets[i+1]
+            if start == end:
+                # fully transparent
+                continue
+
+            left = tx*tile_size
+            top = ty*tile_size
+            tile = np.frombuffer(zlib.decompress(tiles[start:end]), dtype=np.uint8).reshape(
+                min(tile_size, height-top), min(tile_size, width-left), 4,
+            )
+            # overlap of the tile and rect, in image coordinates
+            ox0, oy0 = max(x0, left), max(y0, top)
+            ox1, oy1 = min(x1, left+tile.shape[1]), min(y1, top+tile.shape[0])
+            out[oy0-y0:oy1-y0, ox0-x0:ox1-x0] = tile[oy0-top:oy1-top, ox0-left:ox1-left]
+
+    return Image.fromarray(out, "RGBA")
+
+
+class Pack(object):
+    """A memory-mapped pack of images
+
+    The images of untiled packs are read only views of the
+    mapped file, so they must not be modified in place (crop,
+    reduce, etc. all return new images and are fine). Images of
+    tiled packs are decompressed into new images every time.
+    """
+
+    def __init__(self, pack_path: str):
+        with open(os.path.join(pack_path, INDEX_FILE)) as index_file:
+            index = json.load(index_file)
+        if index["version"] != VERSION:
+            raise RuntimeError(f"unsupported pack version {index['version']}")
+        self.entries: Dict[str, Dict[str, Any]] = index["images"]
+        self.tile_size: int = index.get("tile_size", TILE_SIZE)
+
+        # the mappings stay valid after the files are closed
+        self._map = _map_file(os.path.join(pack_path, PIXELS_FILE))
+        self._tiles_map = _map_file(os.path.join(pack_path, TILES_FILE))
+        self._opaque_map = _map_file(os.path.join(pack_path, OPAQUE_FILE))
+
+    def is_tiled(self, name: str) -> bool:
+        return "tile_offsets" in self.entries[name]
+
+    def image(self, name: str) -> Image.Image:
+        entry = self.entries[name]
+        if "tile_offsets" in entry:
+            return self.crop(name, (0, 0, entry["width"], entry["height"]))
+
+        if self._map is None:
+            raise RuntimeError(f"pack has untiled images but no {PIXELS_FILE}")
+        size = (entry["width"], entry["height"])
+        # zero copy: the image's pixels are the mapped pages
+        pixels = np.frombuffer(
+            self._map, dtype=np.uint8,
+            count=size[0]*size[1]*4, offset=entry["offset"],
+        )
+        return Image.frombuffer(
+            "RGBA", size, pixels,
+            "raw", "RGBA", 0, 1,
+        )
+
+    def crop(self, name: str, rect: Tuple[int, int, int, int]) -> Image.Image:
+        # same as image(name).crop(rect), except tiled images
+        # only decompress the tiles overlapping rect
+        entry = self.entries[name]
+        if "tile_offsets" not in entry:
+            return self.image(name).crop(rect)
+        if self._tiles_map is None:
+            raise RuntimeError(f"pack has tiled images but no {TILES_FILE}")
+        return _crop_tiles(
+            self._tiles_map, entry["tile_offsets"], self.tile_size,
+            entry["width"], entry["height"], rect,
+        )
+
+    def opaque_table(self, name: str) -> Optional[np.ndarray]:
+        entry = self.entries[name]
+        if self._opaque_map is None or "opaque_offset" not in entry:
+            return None
+        shape = (entry["height"]+1, entry["width"]+1)
+        # read only, zero copy view of the mapped table
+        return np.frombuffer(
+            self._opaque_map, dtype="<u4",
+            count=shape[0]*shape[1], offset=entry["opaque_offset"],
+        ).reshape(shape)
+
+
+if __name__ == "__main__":
+    build(*sys.argv[1:])
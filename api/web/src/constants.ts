@@ -11,3 +11,5 @@ export const redis = new ioredis();
 export const origin = process.env.ORIGIN!;
 export const sessionSecret = process.env.SESSION_SECRET!;
 export const port = process.env.PORT!;
+// origin of the image server (api/image), e.g. http://localhost:5000
+export const imageServer = process.env.IMAGE_SERVER!;
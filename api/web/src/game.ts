@@ -1,38 +1,44 @@
 import crypto from "crypto";
 import fs from "fs";
 import ioredis from "ioredis";
-import fetch, { Response } from "node-fetch";
-import url from "url";
+import fetch from "node-fetch";
 
-import { redis } from "./constants";
+import { imageServer, redis } from "./constants";
+import { GuessIndex } from "./guesses";
 import {
   ChatReceiveMessage,
   CorrectGuessMessage,
-  GameData,
   GameSettings,
+  GuessIndexData,
   NewImageMessage,
   RawChatReceiveMessage,
+  RoundData,
   RoundEndMessage,
   RoundStartMessage,
 } from "./interfaces";
 import { sleep, toNumberValues } from "./utils";
 
-const buildSetMap = (jsonData: GameData): Map<string, Set<string>> => {
-  const map: Map<string, Set<string>> = new Map();
-  for (const [charId, data] of Object.entries(jsonData)) {
-    map.set(charId, new Set([data.en_name, ...data.aliases]));
-  }
-  return map;
-};
-
-const charIdFromUrl = (link: url.URL): string => {
-  const first = link.pathname.substring(link.pathname.lastIndexOf("/")+1);
-  return first.substring(0, first.lastIndexOf("_"));
+// image ids are file names: charId_skin
+const charIdFromImageId = (imageId: string): string =>
+  imageId.substring(0, imageId.lastIndexOf("_"));
+
+// /round responses are the length of the json as a 4 byte
+// big endian int, the json, then every step's image
+const parseRound = (body: Buffer): [RoundData, Buffer[]] => {
+  const jsonLength = body.readUInt32BE(0);
+  const round = JSON.parse(body.toString("utf-8", 4, 4+jsonLength)) as RoundData;
+  let offset = 4+jsonLength;
+  const images = round.steps.map((step): Buffer => {
+    const image = body.subarray(offset, offset+step.length);
+    offset += step.length;
+    return image;
+  });
+  return [round, images];
 };
 
-const gameData = buildSetMap(JSON.parse(
-  fs.readFileSync("gamedata/ak_data.json", "utf-8"),
-) as GameData);
+const guessIndex = new GuessIndex(JSON.parse(
+  fs.readFileSync("gamedata/guess_index.json", "utf-8"),
+) as GuessIndexData);
 
 export class Game {
   private readonly name: string;
@@ -84,18 +90,18 @@ export class Game {
       .publish(this.name, JSON.stringify(startBroadcast))
       .exec();
 
-    const newRes = await fetch(
-      // todo: use difficulty, charset, and move origin to config
-      "http://localhost:5000/new",
-      { redirect: "manual" },
+    // every step of the round in one request. seeded, so the
+    // crops are from the image server's seeded positions,
+    // which are the ones a corpus pre-renders (see
+    // SEEDED_POSITIONS in api/image/main.py)
+    const roundRes = await fetch(
+      `${imageServer}/round?difficulty=${this.settings.difficulty}&charset=${this.settings.charset}&seed=${crypto.randomUUID()}`,
     );
-    const link = newRes.headers.get("Location");
-    if (link === null) {
-      throw new Error("get image /new had no Location header");
+    if (!roundRes.ok) {
+      throw new Error(`get image /round failed with ${roundRes.status}`);
     }
-    const firstUrl = new url.URL(link);
-    const charId = charIdFromUrl(firstUrl);
-    let nextUrl: string | undefined = firstUrl.toString();
+    const [roundData, images] = parseRound(await roundRes.buffer());
+    const charId = charIdFromImageId(roundData.char_id);
 
     // players who have already correctly guessed this round.
     // don't need to persist because only one web instance is
@@ -111,7 +117,7 @@ export class Game {
     this.sub.on("message", async (_channel: string, msgStr: string): Promise<void> => {
       const msg = JSON.parse(msgStr) as RawChatReceiveMessage;
       const didGuess = guessed.has(msg.data.author);
-      if (didGuess || !(gameData.get(charId)?.has(msg.data.text.trim()) ?? false)) {
+      if (didGuess || !guessIndex.matches(msg.data.text, charId, this.settings.tolerance ?? 0)) {
         await redis.publish(
           this.name,
           JSON.stringify({
@@ -144,7 +150,7 @@ export class Game {
       }
     });
 
-    while (nextUrl !== undefined) {
+    for (const [step, image] of images.entries()) {
       const startTime = Date.now();
 
       const code = crypto.randomUUID();
@@ -156,20 +162,19 @@ export class Game {
       };
       await redis.pipeline()
         .expire(`${this.gameKey}:alive`, this.settings.interval*2)
-        .set(`images:${code}`, nextUrl, "EX", this.settings.interval*2)
+        // stored as "<content type>\0<image>"
+        .set(
+          `images:${code}`,
+          Buffer.concat([
+            Buffer.from(`image/${roundData.steps[step].format}\0`),
+            image,
+          ]),
+          "EX",
+          this.settings.interval*2,
+        )
         .publish(this.name, JSON.stringify(broadcast))
         .exec();
 
-      // interesting ts can't infer this (because of the loop?)
-      const res: Response = await fetch(nextUrl, { method: "HEAD" });
-
-      const next = res.headers.get("Link")
-                     ?.match(/<([^>]+)>; rel="next"/)
-                     ?.[1];
-      // if next is undefined, res contains the last image of
-      // the round (end round after this call's timer is over)
-      nextUrl = next === undefined ? undefined : firstUrl.origin + next;
-
       const delay = startTime + this.settings.interval*1000 - Date.now();
       if (delay < 0) {
         throw new Error("behind!");
@@ -0,0 +1,133 @@
+import { GuessIndexData } from "./interfaces";
+import { normalizeGuess } from "./utils";
+
+// must match discord-bot/cannedthighs/guesses.py
+
+// the largest tolerance (edit distance) that can be used
+export const MAX_TOLERANCE = 2;
+// guesses get 1 edit of tolerance per this many characters
+const TOLERANCE_LENGTH = 3;
+
+// levenshtein distance, giving up (and returning
+// limit+1) once it must be more than limit
+const distance = (a: string, b: string, limit: number): number => {
+  if (Math.abs(a.length-b.length) > limit) {
+    return limit+1;
+  }
+  if (a.length < b.length) {
+    [a, b] = [b, a];
+  }
+
+  let previous = Array.from({ length: b.length+1 }, (_, j): number => j);
+  for (let i = 0; i < a.length; ++i) {
+    let left = i+1;
+    let best = left;
+    const current = [left];
+    for (let j = 0; j < b.length; ++j) {
+      const cost = Math.min(
+        previous[j] + (a[i] === b[j] ? 0 : 1),
+        previous[j+1]+1,
+        left+1,
+      );
+      current.push(cost);
+      left = cost;
+      best = Math.min(best, cost);
+    }
+    if (best > limit) {
+      return limit+1;
+    }
+    previous = current;
+  }
+  return Math.min(previous[b.length], limit+1);
+};
+
+// every string made by removing up to count characters
+const deletes = (word: string, count: number): Set<string> => {
+  const found = new Set([word]);
+  let edge = new Set([word]);
+  for (let n = 0; n < count; ++n) {
+    const next = new Set<string>();
+    for (const w of edge) {
+      for (let i = 0; i < w.length; ++i) {
+        next.add(w.slice(0, i) + w.slice(i+1));
+      }
+    }
+    next.forEach((w): void => { found.add(w); });
+    edge = next;
+  }
+  return found;
+};
+
+export class GuessIndex {
+  // normalized guess -> every charId it's an answer for
+  private readonly guesses: Map<string, string[]>;
+  // guess with up to MAX_TOLERANCE characters deleted -> guesses
+  // two guesses within distance d always share a string made by
+  // deleting at most d characters from each, so only guesses
+  // sharing one with a message need their distance computed
+  private readonly deletes = new Map<string, string[]>();
+
+  public constructor(jsonData: GuessIndexData) {
+    if (jsonData.version !== 1) {
+      throw new Error(`unsupported guess index version ${jsonData.version}`);
+    }
+    this.guesses = new Map(Object.entries(jsonData.guesses));
+
+    for (const guess of this.guesses.keys()) {
+      for (const deleted of deletes(guess, MAX_TOLERANCE)) {
+        const words = this.deletes.get(deleted);
+        if (words === undefined) {
+          this.deletes.set(deleted, [guess]);
+        } else {
+          words.push(guess);
+        }
+      }
+    }
+  }
+
+  public get(text: string, tolerance = 0): Set<string> {
+    const form = normalizeGuess(text);
+    const exact = this.guesses.get(form);
+    if (exact !== undefined) {
+      return new Set(exact);
+    }
+
+    // short guesses need to be exact, otherwise nearly
+    // any 3 letters would be a few edits from something
+    tolerance = Math.min(
+      tolerance,
+      MAX_TOLERANCE,
+      Math.floor(form.length/TOLERANCE_LENGTH),
+    );
+    if (tolerance <= 0) {
+      return new Set();
+    }
+
+    const found = new Map<string, number>();
+    for (const deleted of deletes(form, tolerance)) {
+      for (const word of this.deletes.get(deleted) ?? []) {
+        if (!found.has(word)) {
+          found.set(word, distance(form, word, tolerance));
+        }
+      }
+    }
+
+    // only the closest guesses count, so a typo closer to
+    // another operator's name doesn't count for this one
+    const closest = Math.min(...found.values());
+    const charIds = new Set<string>();
+    if (closest > tolerance) {
+      return charIds;
+    }
+    for (const [word, d] of found) {
+      if (d === closest) {
+        this.guesses.get(word)?.forEach((charId): void => { charIds.add(charId); });
+      }
+    }
+    return charIds;
+  }
+
+  public matches(text: string, charId: string, tolerance = 0): boolean {
+    return this.get(text, tolerance).has(charId);
+  }
+}
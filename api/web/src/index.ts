@@ -3,7 +3,6 @@ import express from "express";
 import expressSession from "express-session";
 import http from "http";
 import type net from "net";
-import fetch from "node-fetch";
 import websocket from "ws";
 
 import { Client } from "./client";
@@ -102,7 +101,7 @@ app.post("/enter", async (req, res): Promise<void> => {
 
   await redis.pipeline()
     // todo: proper settings
-    .hset(key, "rounds", 5, "interval", 5, "charset", 0, "difficulty", 0)
+    .hset(key, "rounds", 5, "interval", 5, "charset", 0, "difficulty", 0, "tolerance", 1)
     .hset(`${key}:scores`, playerName, 0)
     .exec();
 });
@@ -151,31 +150,22 @@ app.get("/images/:imageCode", async (req, res): Promise<void> => {
     return;
   }
 
-  const link = await redis.get(`images:${req.params.imageCode}`);
-  if (link === null) {
+  // stored by the game as "<content type>\0<image>"
+  const stored = await redis.getBuffer(`images:${req.params.imageCode}`);
+  if (stored === null) {
     fail(res, 404, "No such image found");
     return;
   }
-
-  const imageRes = await fetch(link);
-
-  const type = imageRes.headers.get("Content-Type");
-  const length = imageRes.headers.get("Content-Length");
-
-  if (type === null || length === null) {
-    throw new Error(`get image ${link} had bad response`);
-  }
+  const split = stored.indexOf(0);
 
   res
-    .header("Content-Type", type)
-    .header("Content-Length", length)
+    .header("Content-Type", stored.toString("utf-8", 0, split))
     // https://stackoverflow.com/questions/35416277/allow-reverse-proxy-cache-but-not-browser-cache
     .header("Cache-Control", "public, max-age=0, s-maxage=20")
     .header("Access-Control-Allow-Origin", origin)
     // .header("Access-Control-Allow-Origin", "*")
-    .header("Access-Control-Allow-Credentials", "true");
-
-  imageRes.body.pipe(res);
+    .header("Access-Control-Allow-Credentials", "true")
+    .send(stored.subarray(split+1));
 });
 
 const server = http.createServer(app);
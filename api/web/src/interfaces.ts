@@ -18,11 +18,28 @@ export interface Session extends http.IncomingMessage {
   };
 }
 
+// json part of an image server /round response
+export interface RoundData {
+  char_id: string;
+  x: number;
+  y: number;
+  difficulty: number;
+  mode: string;
+  steps: Array<{
+    link: string;
+    format: string;
+    length: number;
+  }>;
+}
+
 export interface GameSettings {
   rounds: number;
   difficulty: number;
   interval: number;
   charset: number;
+  // typos (edit distance) allowed in a guess, see guesses.ts.
+  // missing from games stored before it was added
+  tolerance?: number;
 }
 
 interface Message {
@@ -143,9 +160,9 @@ declare module "express-session" {
   }
 }
 
-export interface GameData {
-  [charId: string]: {
-    en_name: string;
-    aliases: string[];
+export interface GuessIndexData {
+  version: number;
+  guesses: {
+    [normalizedGuess: string]: string[];
   };
 }
@@ -2,6 +2,12 @@ export const filterId = (id: string): boolean => /^[\w\-]{4,50}$/.test(id);
 export const filterName = (name: string): boolean => /^[\w\-]{1,50}$/.test(name);
 export const filterMessage = (text: string): boolean => /^[\s\w\-\'\.\,]+$/.test(text);
 
+// must match normalize() in gamedata/ak_data.py and
+// discord-bot/cannedthighs/guesses.py: ignore case,
+// width/compatibility forms, whitespace and punctuation
+export const normalizeGuess = (text: string): string =>
+  text.normalize("NFKC").toLowerCase().replace(/[^\p{L}\p{N}]/gu, "");
+
 const randomChars = "abcdefghijklmnopqrstuvwxyz0123456789";
 export const getGameName = (): string => {
   let s = "";
@@ -15,12 +15,14 @@ class Game(object):
     __slots__ = (
         "_NUM_ROUNDS",
         "_IMAGE_MODE",
+        "_TOLERANCE",
         "_current_image",
         "_current_round",
         "_expansion_count",
         "_current_position",
         "_scores",
         "_render_lock",
+        "_state_lock",
     )
 
     def __init__(
@@ -28,14 +30,18 @@ class Game(object):
         num_rounds: Optional[int] = None,
         *,
         image_mode: Optional[str] = None,
+        tolerance: Optional[int] = None,
     ):
         if num_rounds is None:
             num_rounds = cannedthighs.conf.default_rounds
         if image_mode is None:
             image_mode = cannedthighs.conf.default_format
+        if tolerance is None:
+            tolerance = cannedthighs.conf.default_tolerance
 
         self._NUM_ROUNDS: int = num_rounds
         self._IMAGE_MODE: str = image_mode
+        self._TOLERANCE: int = tolerance
 
         self._current_image: Optional[TaggedImage] = None
         self._current_round: int = 0
@@ -46,6 +52,10 @@ class Game(object):
 
         # to prevent spamming of image loading
         self._render_lock: asyncio.Lock = asyncio.Lock()
+        # rendering methods also change the round, and run on
+        # render threads, so only let one run at a time (and
+        # don't check answers against a round that's changing)
+        self._state_lock: asyncio.Lock = asyncio.Lock()
 
     def __str__(self) -> str:
         # game.scores: ((player_id_1, score_1), (player_id_2, score_2), ...)
@@ -67,7 +77,21 @@ class Game(object):
         return f"Round {self._current_round}/{self._NUM_ROUNDS}\n{score_str}"
 
     def start_round(self) -> "discord.File":
-        self._current_image = random.choice(cannedthighs.conf.images)
+        images = cannedthighs.conf.images
+        size = cannedthighs.conf.get_size(0)
+        threshold = cannedthighs.conf.opaque_threshold
+
+        # skip images which can't produce a starting position
+        # instead of searching them forever. every image is
+        # tried once, in a random order, so an image is found
+        # whenever one exists
+        for image in random.sample(images, len(images)):
+            if len(image.get_centers(size, threshold)) > 0:
+                break
+        else:
+            raise RuntimeError(f"no image has a {size}px area at least {threshold} opaque")
+
+        self._current_image = image
         self._current_round += 1
 
         return self.reset_round()
@@ -83,29 +107,19 @@ class Game(object):
 
         self._expansion_count = 0
         size = cannedthighs.conf.get_size(self._expansion_count)
-        half_size = size//2
-
-        im = self._current_image.image
 
         s = time.perf_counter_ns()
-        n = 0
-        img_buf = None
-        while img_buf is None:
-            self._current_position = (
-                random.randint(half_size, im.width-half_size),
-                random.randint(half_size, im.height-half_size),
-            )
-            img_buf = image_generator.generate_if_opaque(
-                im,
-                self._IMAGE_MODE,
-                size,
-                *self._current_position,
-            )
-            n += 1
+        centers = self._current_image.get_centers(
+            size,
+            cannedthighs.conf.opaque_threshold,
+        )
+        if len(centers) == 0:
+            raise RuntimeError("current image has no valid starting position")
+        self._current_position = centers.choice()
         e = time.perf_counter_ns()
-        print(f"new {size}: {n}, {(e-s)/1000000} ms, {img_buf.fp.getbuffer().nbytes/1000} KB")
+        print(f"new {size}: {len(centers)} centers, {(e-s)/1000000} ms")
 
-        return img_buf
+        return self.view_image()
 
     def view_image(self) -> "discord.File":
         if self._current_image is None:
@@ -115,7 +129,7 @@ class Game(object):
 
         s = time.perf_counter_ns()
         img_buf = image_generator.generate(
-            self._current_image.image,
+            self._current_image,
             self._IMAGE_MODE,
             size,
             *self._current_position,
@@ -129,7 +143,11 @@ class Game(object):
         if self._current_image is None:
             return False
 
-        return answer.lower() in self._current_image
+        return cannedthighs.conf.guess_index.matches(
+            answer,
+            self._current_image.char_id,
+            self._TOLERANCE,
+        )
 
     def end_round(self, winner: Optional[int]) -> Optional["discord.File"]:
         if winner is not None:
@@ -149,3 +167,7 @@ class Game(object):
     @property
     def render_lock(self) -> asyncio.Lock:
         return self._render_lock
+
+    @property
+    def state_lock(self) -> asyncio.Lock:
+        return self._state_lock
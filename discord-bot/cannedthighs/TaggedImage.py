@@ -1,24 +1,128 @@
-from typing import Any, Set
+from typing import Callable, Dict, Hashable, Optional, Tuple
 
+import numpy as np
 from PIL import Image
 
+from cannedthighs import opacity
+from cannedthighs.image_cache import DecodedImageCache
+
+
+def _get_image_size(im: Image.Image) -> int:
+    return im.width*im.height*len(im.getbands())
+
+
+def _get_table_size(table: np.ndarray) -> int:
+    return table.nbytes
+
 
 class TaggedImage(object):
     __slots__ = (
         "_image",
-        "_names",
+        "_char_id",
+        "_opaque_table",
+        "_center_indexes",
+        "_source",
+        "_opener",
+        "_cache",
+        "_cropper",
+        "_size",
     )
 
-    def __init__(self, image: Image.Image, *names: str):
+    def __init__(
+        self,
+        image: Optional[Image.Image],
+        char_id: str,
+        *,
+        opaque_table: Optional[np.ndarray] = None,
+        source: Optional[Tuple[str, Hashable]] = None,
+        opener: Optional[Callable[[], Image.Image]] = None,
+        cache: Optional[DecodedImageCache] = None,
+        cropper: Optional[Callable[[Tuple[int, int, int, int]], Image.Image]] = None,
+        size: Optional[Tuple[int, int]] = None,
+    ):
+        # either image is kept (and decoded by pillow on first
+        # use, then kept decoded), or image is None and opener
+        # is called to decode it whenever it isn't in cache (or
+        # every time, without a cache). cropper, if given, makes
+        # crops without needing the whole image (tiled packs)
+        if image is None and opener is None:
+            raise ValueError("an image or an opener is required")
         self._image = image
-        self._names: Set[str] = set(names)
+        self._opener = opener
+        self._cache = cache
+        self._cropper = cropper
+        self._size = size
+        self._char_id = char_id
+        self._opaque_table: Optional[np.ndarray] = opaque_table
+        self._center_indexes: Dict[Tuple[int, float], opacity.CenterIndex] = {}
+        # (file name, signature) of where the image was loaded
+        # from, the signature changing whenever the file does
+        self._source = source
 
-    def __contains__(self, other: Any) -> bool:
-        if type(other) != str:
-            return False
+    @property
+    def char_id(self) -> str:
+        return self._char_id
 
-        return other in self._names
+    @property
+    def source(self) -> Optional[Tuple[str, Hashable]]:
+        return self._source
 
     @property
     def image(self) -> Image.Image:
-        return self._image
+        if self._image is not None:
+            return self._image
+        if self._cache is None:
+            return self._decode()
+        return self._cache.get((self, "image"), self._decode, _get_image_size)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        if self._size is None:
+            if self._image is not None:
+                self._size = self._image.size
+            else:
+                # opening only reads the header
+                with self._open() as im:
+                    self._size = im.size
+        return self._size
+
+    def crop(self, rect: Tuple[int, int, int, int]) -> Image.Image:
+        if self._cropper is not None:
+            return self._cropper(rect)
+        return self.image.crop(rect)
+
+    def _open(self) -> Image.Image:
+        # only used when no image is kept, which __init__
+        # only allows with an opener
+        if self._opener is None:
+            raise ValueError("an image or an opener is required")
+        return self._opener()
+
+    def _decode(self) -> Image.Image:
+        im = self._open()
+        im.load()
+        return im
+
+    @property
+    def opaque_table(self) -> np.ndarray:
+        if self._opaque_table is not None:
+            return self._opaque_table
+        # built on first use since it requires
+        # decoding the whole image
+        if self._cache is None:
+            self._opaque_table = opacity.get_opaque_table(self.image)
+            return self._opaque_table
+        # as big as the image, so it's evicted like one
+        return self._cache.get(
+            (self, "opaque_table"),
+            lambda: opacity.get_opaque_table(self.image),
+            _get_table_size,
+        )
+
+    def get_centers(self, size: int, threshold: float) -> opacity.CenterIndex:
+        key = (size, threshold)
+        index = self._center_indexes.get(key)
+        if index is None:
+            index = opacity.get_center_index(self.opaque_table, size, threshold)
+            self._center_indexes[key] = index
+        return index
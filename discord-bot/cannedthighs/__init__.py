@@ -1,10 +1,12 @@
 import json
 import os
-from typing import Any, Callable, Dict, List, Literal
+from typing import Any, Callable, Dict, List, Literal, Optional
 
 import dotenv
 
-from cannedthighs import image_setup
+from cannedthighs import guesses, image_setup
+from cannedthighs.image_cache import DecodedImageCache
+from cannedthighs.TaggedImage import TaggedImage
 
 dotenv.load_dotenv()
 
@@ -74,7 +76,10 @@ def _get_expansion_function(
 
 
 _FormatName = str
-_FormatKeys = Literal["maxsize", "format", "reduce", "args"]
+_FormatKeys = Literal[
+    "maxsize", "format", "reduce", "args",
+    "target_bytes", "budget_ms", "min_psnr",
+]
 _Format = List[Dict[_FormatKeys, Any]]
 
 
@@ -119,19 +124,57 @@ class _Config(object):
             means that Pillow should lazy-load the images. Note that
             since images are decompressed, RAM usage is likely to be
             a lot higher than the total size on disk of the image
-            folder.
+            folder. Has no effect if image_cache_size is set.
             Env: PRELOAD_IMAGES
             Default: False
+        image_cache_size (int): The most memory, in MB, used by
+            decoded images (and their opacity tables). If set,
+            images are decoded when needed and the least recently
+            used ones are dropped once this is exceeded, so memory
+            stays bounded while frequently shown operators stay
+            decoded. Leaving it unset or set to 0 means images are
+            kept decoded forever once used (see preload_images).
+            Has no effect with image_pack, where images are never
+            decoded. Never reloaded.
+            Env: IMAGE_CACHE_SIZE
+            Default: 0
+        image_cache (Optional[DecodedImageCache]): The cache used
+            if image_cache_size is set, otherwise None.
+        render_threads (int): The number of threads used to render
+            images, so encoding doesn't block the bot from
+            handling messages. Never reloaded.
+            Env: RENDER_THREADS
+            Default: 4
+        load_threads (int): The number of threads used to open
+            (and with preload_images, decode) images when loading
+            or reloading them. Never reloaded.
+            Env: LOAD_THREADS
+            Default: 8
+        render_per_guild (int): The number of images one guild
+            can have rendering at the same time, so one busy
+            guild can't use every render thread. Never reloaded.
+            Env: RENDER_PER_GUILD
+            Default: 1
+        image_pack (Optional[str]): Path to a folder containing a
+            pack of the images in image_path, built with
+            api/image/store.py. If set, images are memory-mapped
+            from the pack, which is already decoded, instead of
+            being decoded from image_path, so preload_images has
+            no effect. Leaving it unset or set to an empty string
+            means images are read from image_path.
+            Env: IMAGE_PACK
+            Default: None
 
         The following are controlled by the environment variable
         GAMEDATA_PATH, which is a path to a folder containing the
-        files name_aliases.json, image_setup.json, formats.json, and
+        files guess_index.json, image_setup.json, formats.json, and
         game_settings.json, defaulting to "gamedata" (in the current
         directory):
 
-        alias_file (str): The path to the json file containing
-            operator aliases, aka valid words/phrases that will be
-            accepted as equivalent to the full name by the game.
+        guess_index (GuessIndex): Every valid word/phrase that
+            will be accepted as an answer, normalized, mapped to the
+            operators it's an answer for. Generated from the
+            operator names and name_aliases.json by ak_data.py.
         image_setup_file (str): The path to the json file containing
             data to be used by image_setup.py, such as images to
             exclude from the game.
@@ -155,6 +198,11 @@ class _Config(object):
                     when saving each type of image. Can be used to
                     specify levels of compression on formats like png
                     and webp.
+                target_bytes, budget_ms, min_psnr: Only used by the
+                    image server for formats set to "auto", which
+                    pick an encoder from measured costs (see
+                    api/image/encoders.py). The bot encodes auto
+                    formats as webp using args.
 
         The following are loaded from game_settings.json:
 
@@ -179,6 +227,12 @@ class _Config(object):
             json file).
         default_rounds (int): The default number of rounds a game
             should contain, unless a different number is requested.
+        default_tolerance (int): The default number of typos (edit
+            distance) allowed in a guess, unless a game is started
+            with a different tolerance. Short guesses get less (see
+            guesses.GuessIndex.get), and at most
+            guesses.MAX_TOLERANCE is used. 0 only allows exact
+            guesses.
         opaque_threshold (float): The minimum percentage of fully
             opaque pixels a starting image needs for it to be sent
             out in the game. Prevents the bot from starting on a
@@ -190,13 +244,18 @@ class _Config(object):
 
     __slots__ = (
         "_discord_token",
+        "_render_threads",
+        "_load_threads",
+        "_image_cache",
+        "_render_per_guild",
         "_bot_owner",
         "_translation_file",
         "_character_list_file",
         "_image_path",
         "_file_name",
         "_preload_images",
-        "_alias_file",
+        "_image_pack",
+        "_guess_index",
         "_image_setup_file",
         "_file_formats",
         "_get_size",
@@ -204,16 +263,38 @@ class _Config(object):
         "__dict__",
     )
 
+    # set from game_settings.json by __init__, declared here
+    # so their types are known
+    default_format: str
+    default_rounds: int
+    default_tolerance: int
+    opaque_threshold: float
+
     def __init__(self):
         self._discord_token: str = _require_env("DISCORD_BOT_TOKEN")
+        self._render_threads: int = int(os.getenv("RENDER_THREADS", "4"))
+        self._load_threads: int = int(os.getenv("LOAD_THREADS", "8"))
+        image_cache_size = int(os.getenv("IMAGE_CACHE_SIZE", "0") or "0")
+        self._image_cache: Optional[DecodedImageCache] = (
+            DecodedImageCache(image_cache_size*1000000)
+            if image_cache_size > 0
+            else None
+        )
+        self._render_per_guild: int = int(os.getenv("RENDER_PER_GUILD", "1"))
+        self._images: List[TaggedImage] = []
         self.update(True)
 
-    def update(self, reloadImages: bool = False):
+    def update(self, reloadImages: bool = False, fullReload: bool = False):
+        # images are reloaded incrementally: only files which
+        # were added or changed since the last load are opened,
+        # unless fullReload is set. games in progress keep
+        # the images they already have either way
         # if an optional environment variable was deleted,
         # it would never be reset by load_dotenv, so we must
         # manually reset them.
         os.environ["FILE_NAME"] = "canned_thighs"
         os.environ["PRELOAD_IMAGES"] = ""
+        os.environ["IMAGE_PACK"] = ""
         os.environ["GAMEDATA_PATH"] = "gamedata"
 
         dotenv.load_dotenv(override=True)
@@ -229,10 +310,20 @@ class _Config(object):
         env = os.getenv("PRELOAD_IMAGES")
         self._preload_images: bool = False if env is None or env == "" else True
 
+        env = os.getenv("IMAGE_PACK")
+        self._image_pack: Optional[str] = None if env is None or env == "" else env
+
         # load data
         gamedata: str = os.getenv("GAMEDATA_PATH", "gamedata")
 
-        self._alias_file: str = os.path.join(gamedata, "name_aliases.json")
+        guess_index = guesses.GuessIndex(os.path.join(gamedata, "guess_index.json"))
+        if not reloadImages:
+            # the names image_setup.get_images added to the old
+            # index (e.g. chinese names) are only added again
+            # when images are reloaded
+            for guess, char_id in self._guess_index.added:
+                guess_index.add(guess, char_id)
+        self._guess_index: guesses.GuessIndex = guess_index
         self._image_setup_file: str = os.path.join(gamedata, "image_setup.json")
 
         with open(os.path.join(gamedata, "formats.json")) as format_file:
@@ -246,6 +337,7 @@ class _Config(object):
                 "expansion_equation",
                 "default_format",
                 "default_rounds",
+                "default_tolerance",
                 "opaque_threshold",
             ]
         )
@@ -254,12 +346,31 @@ class _Config(object):
         self.__dict__.update(**settings)
 
         if reloadImages:
-            self._images = image_setup.get_images(self)
+            self._images = image_setup.get_images(
+                self,
+                None if fullReload else self._images,
+            )
 
     @property
     def discord_token(self):
         return self._discord_token
 
+    @property
+    def render_threads(self):
+        return self._render_threads
+
+    @property
+    def load_threads(self):
+        return self._load_threads
+
+    @property
+    def image_cache(self):
+        return self._image_cache
+
+    @property
+    def render_per_guild(self):
+        return self._render_per_guild
+
     @property
     def bot_owner(self):
         return self._bot_owner
@@ -285,8 +396,12 @@ class _Config(object):
         return self._preload_images
 
     @property
-    def alias_file(self):
-        return self._alias_file
+    def image_pack(self):
+        return self._image_pack
+
+    @property
+    def guess_index(self):
+        return self._guess_index
 
     @property
     def image_setup_file(self):
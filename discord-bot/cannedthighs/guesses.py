@@ -0,0 +1,193 @@
+import json
+import unicodedata
+from typing import Dict, FrozenSet, List, Set, Tuple
+
+
+# the largest tolerance (edit distance) that can be used
+MAX_TOLERANCE = 2
+# guesses get 1 edit of tolerance per this many characters
+TOLERANCE_LENGTH = 3
+
+
+# must match normalize() in gamedata/ak_data.py
+# and normalizeGuess() in api/web/src/utils.ts
+def normalize(text: str) -> str:
+    # ignore case, width/compatibility forms, whitespace and
+    # punctuation, e.g. "Lancet-2" -> "lancet2"
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(c for c in text if c.isalnum())
+
+
+def _distance(a: str, b: str, limit: int) -> int:
+    # levenshtein distance, giving up (and returning
+    # limit+1) once it must be more than limit
+    if abs(len(a)-len(b)) > limit:
+        return limit+1
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous = list(range(len(b)+1))
+    for i, ca in enumerate(a):
+        left = i+1
+        current = [left]
+        best = left
+        for j, cb in enumerate(b):
+            cost = previous[j] if ca == cb else previous[j]+1
+            if previous[j+1]+1 < cost:
+                cost = previous[j+1]+1
+            if left+1 < cost:
+                cost = left+1
+            current.append(cost)
+            left = cost
+            if cost < best:
+                best = cost
+        if best > limit:
+            return limit+1
+        previous = current
+    return min(previous[-1], limit+1)
+
+
+def _deletes(word: str, distance: int) -> Set[str]:
+    # every string made by removing up to distance characters
+    found = {word}
+    edge = {word}
+    for _ in range(distance):
+        edge = {
+            w[:i]+w[i+1:]
+            for w in edge
+            for i in range(len(w))
+        }
+        found |= edge
+    return found
+
+
+class FuzzyIndex(object):
+    """Finds every word within an edit distance of a query
+    without comparing against every word
+
+    Two words within distance d of each other always share a
+    string made by deleting at most d characters from each,
+    so those deletions are indexed up front, and a query only
+    computes the real distance to words sharing one with it.
+
+    Args:
+        words (List[str]): The words to search through.
+        max_distance (int): The largest distance that can be
+            searched for. The index grows quickly with this.
+    """
+
+    __slots__ = (
+        "_deletes",
+        "_max_distance",
+    )
+
+    def __init__(self, words: List[str], max_distance: int):
+        self._max_distance = max_distance
+        self._deletes: Dict[str, List[str]] = {}
+        for word in words:
+            self.add(word)
+
+    def add(self, word: str) -> None:
+        for deleted in _deletes(word, self._max_distance):
+            self._deletes.setdefault(deleted, []).append(word)
+
+    def search(self, query: str, distance: int) -> Dict[str, int]:
+        distance = min(distance, self._max_distance)
+        found: Dict[str, int] = {}
+        checked: Set[str] = set()
+        for deleted in _deletes(query, distance):
+            for word in self._deletes.get(deleted, ()):
+                if word in checked:
+                    continue
+                checked.add(word)
+                d = _distance(query, word, distance)
+                if d <= distance:
+                    found[word] = d
+        return found
+
+
+class GuessIndex(object):
+    """Every accepted answer, normalized, mapped to the
+    characters it is an answer for. Built by
+    gamedata/ak_data.py as guess_index.json, and completed with
+    the names in the translation data when the bot loads its
+    images (see image_setup.get_images).
+    """
+
+    __slots__ = (
+        "_guesses",
+        "_char_ids",
+        "_fuzzy",
+        "_added",
+    )
+
+    def __init__(self, path: str):
+        with open(path, encoding="utf-8") as index_file:
+            index = json.load(index_file)
+        if index["version"] != 1:
+            raise RuntimeError(f"unsupported guess index version {index['version']}")
+        self._guesses: Dict[str, Tuple[str, ...]] = {
+            form: tuple(char_ids)
+            for form, char_ids in index["guesses"].items()
+        }
+        self._char_ids: FrozenSet[str] = frozenset(
+            char_id
+            for char_ids in self._guesses.values()
+            for char_id in char_ids
+        )
+
+        self._fuzzy = FuzzyIndex(list(self._guesses), MAX_TOLERANCE)
+        # (guess, char_id) of every call to add which changed
+        # the index, so a rebuilt index can be given them too
+        self._added: List[Tuple[str, str]] = []
+
+    def __contains__(self, char_id: str) -> bool:
+        return char_id in self._char_ids
+
+    def add(self, guess: str, char_id: str) -> bool:
+        # makes guess an answer for char_id, for names the
+        # index was built without. returns whether it wasn't
+        # already one
+        form = normalize(guess)
+        if form == "":
+            return False
+        char_ids = self._guesses.get(form, ())
+        if char_id in char_ids:
+            return False
+        if len(char_ids) == 0:
+            self._fuzzy.add(form)
+        self._guesses[form] = (*char_ids, char_id)
+        self._char_ids = self._char_ids | {char_id}
+        self._added.append((guess, char_id))
+        return True
+
+    @property
+    def added(self) -> List[Tuple[str, str]]:
+        return self._added
+
+    def get(self, guess: str, tolerance: int = 0) -> Set[str]:
+        form = normalize(guess)
+        exact = self._guesses.get(form)
+        if exact is not None:
+            return set(exact)
+
+        # short guesses need to be exact, otherwise nearly
+        # any 3 letters would be a few edits from something
+        tolerance = min(tolerance, len(form)//TOLERANCE_LENGTH)
+        if tolerance <= 0:
+            return set()
+
+        found = self._fuzzy.search(form, tolerance)
+        if len(found) == 0:
+            return set()
+        # only the closest forms count, so a typo closer to
+        # another operator's name doesn't count for this one
+        closest = min(found.values())
+        return {
+            char_id
+            for match, d in found.items() if d == closest
+            for char_id in self._guesses[match]
+        }
+
+    def matches(self, guess: str, char_id: str, tolerance: int = 0) -> bool:
+        return char_id in self.get(guess, tolerance)
@@ -0,0 +1,81 @@
+import collections
+import threading
+from typing import Any, Callable, Hashable, OrderedDict, Tuple
+
+
+class DecodedImageCache(object):
+    """LRU of decoded images (and anything else built from them)
+    bounded by their total size in memory
+
+    Used from render threads, so it's thread-safe. Loading happens
+    outside the lock, so a slow decode doesn't block hits for
+    other images. Two threads missing the same key at once both
+    load it, and one result is kept.
+
+    Args:
+        max_bytes (int): The total size of cached values above which
+            the least recently used values are evicted.
+    """
+
+    __slots__ = (
+        "_max_bytes",
+        "_entries",
+        "_lock",
+        "_bytes",
+        "_hits",
+        "_misses",
+        "_evictions",
+    )
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        # key -> (value, size in bytes)
+        self._entries: OrderedDict[Hashable, Tuple[Any, int]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(
+        self,
+        key: Hashable,
+        load: Callable[[], Any],
+        get_size: Callable[[Any], int],
+    ) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+
+        value = load()
+        size = get_size(value)
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+
+            # always keep the newest value, even if it's bigger
+            # than the whole cache, since it's about to be used
+            while self._bytes > self._max_bytes and len(self._entries) > 1:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._evictions += 1
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "resident": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+            }
@@ -1,10 +1,11 @@
 import io
-from typing import Optional, Tuple
+from typing import Tuple
 
 import discord
 from PIL import Image
 
 import cannedthighs
+from cannedthighs.TaggedImage import TaggedImage
 
 
 def _center_and_nudge(
@@ -49,15 +50,6 @@ def _center_and_nudge(
     )
 
 
-def _get_opaque_percentage(im: Image.Image) -> float:
-    return (
-        # count the number of fully opaque pixels
-        im.getchannel("A").histogram()[255]
-        # divide by total number of pixels
-        / (im.width*im.height)
-    )
-
-
 def _get_file(im: Image.Image, mode: str) -> discord.File:
     render_settings = cannedthighs.conf.file_formats[mode]
 
@@ -71,6 +63,10 @@ def _get_file(im: Image.Image, mode: str) -> discord.File:
             if reduce > 1:
                 im = im.reduce(reduce)
             img_format = setting["format"]
+            if img_format == "auto":
+                # the bot has no calibration data, so use the
+                # fallback arguments given for the image server
+                img_format = "webp"
             im.save(img_buf, img_format, **setting["args"])
             break
     else:
@@ -90,25 +86,13 @@ def _get_file(im: Image.Image, mode: str) -> discord.File:
 
 
 def generate(
-    base: Image.Image,
+    base: TaggedImage,
     mode: str,
     size: int,
     x: int, y: int,
 ) -> discord.File:
-    cropped = base.crop(_center_and_nudge(x, y, size, base.width, base.height))
+    # only decodes the cropped part if base supports it
+    cropped = base.crop(_center_and_nudge(x, y, size, *base.size))
 
     return _get_file(cropped, mode)
 
-
-def generate_if_opaque(
-    base: Image.Image,
-    mode: str,
-    size: int,
-    x: int, y: int,
-) -> Optional[discord.File]:
-    cropped = base.crop(_center_and_nudge(x, y, size, base.width, base.height))
-
-    if _get_opaque_percentage(cropped) < cannedthighs.conf.opaque_threshold:
-        return None
-
-    return _get_file(cropped, mode)
@@ -1,17 +1,50 @@
 # kept updated with files from https://github.com/Aceship/AN-EN-Tags
-import glob
+from concurrent import futures
+import functools
 import json
 import os
-from typing import Dict, FrozenSet, List, Tuple
+import time
+from typing import Callable, Dict, FrozenSet, Hashable, List, Optional, Tuple
 
 from PIL import Image
 
+from cannedthighs import store
 from cannedthighs.TaggedImage import TaggedImage
 
 
+# (file name, signature) of an image, see TaggedImage.source
+_Source = Tuple[str, Hashable]
+# opens an image as the given char_id and source
+_Opener = Callable[[str, _Source], TaggedImage]
+
+
+def _get_char_id(name: str) -> str:
+    # char_1234_abcd_...
+    # ^^^^^^^^^^^^^^
+    try:
+        return name[:name.index("_", name.index("_", 5)+1)]
+    except ValueError:
+        return os.path.splitext(name)[0]
+
+
+def _preload(img: TaggedImage, packed: bool) -> None:
+    # packed images are already decoded
+    if not packed:
+        img.image.load()
+    # the table needs the decoded image anyways,
+    # so build it now rather than mid-game
+    img.opaque_table
+
+
 # avoid circular dependency between __init__ and this
-# file by passing cannedthighs.conf as a param
-def get_images(conf) -> List[TaggedImage]:
+# file by passing cannedthighs.conf as a param.
+# images in previous whose files haven't changed are
+# reused rather than opened again, so only new and
+# changed files are loaded
+def get_images(
+    conf,
+    previous: Optional[List[TaggedImage]] = None,
+) -> List[TaggedImage]:
     # setup
     with open(
         conf.image_setup_file,
@@ -28,9 +61,6 @@ def get_images(conf) -> List[TaggedImage]:
         # which need to be converted to latin
         TRANSLATION_OVERRIDES: Dict[str, str] = _setup_data["translationOverrides"]
 
-    with open(conf.alias_file, encoding="utf-8") as _alias_file:
-        ALIASES: Dict[str, Tuple[str, ...]] = json.load(_alias_file)
-
     # load translations
     TRANSLATIONS: Dict[str, str] = {}
 
@@ -53,9 +83,84 @@ def get_images(conf) -> List[TaggedImage]:
             TRANSLATIONS[cn_name.lower()] = char["name_en"].lower()
 
     # load images
-    images: List[TaggedImage] = []
-
-    def _load_character(char_id: str, cn_name: str) -> bool:
+    s = time.perf_counter_ns()
+
+    # file name -> (signature, opener), where the signature
+    # changes whenever the file does
+    openers: Dict[str, Tuple[Hashable, _Opener]] = {}
+    if conf.image_pack is not None:
+        pack = store.Pack(conf.image_pack)
+
+        def _open_packed(name: str, char_id: str, source: _Source) -> TaggedImage:
+            if pack.is_tiled(name):
+                # compressed, so only crops are decompressed, and
+                # the whole image only when it's needed
+                pack_entry = pack.entries[name]
+                return TaggedImage(
+                    None,
+                    char_id,
+                    opaque_table=pack.opaque_table(name),
+                    source=source,
+                    opener=functools.partial(pack.image, name),
+                    cache=conf.image_cache,
+                    cropper=functools.partial(pack.crop, name),
+                    size=(pack_entry["width"], pack_entry["height"]),
+                )
+            return TaggedImage(
+                pack.image(name),
+                char_id,
+                opaque_table=pack.opaque_table(name),
+                source=source,
+            )
+
+        # packs built without hashes can only identify an
+        # image by where it is in that build of the pack
+        built = os.stat(os.path.join(conf.image_pack, store.INDEX_FILE)).st_mtime_ns
+        for name, pack_entry in pack.entries.items():
+            signature = pack_entry.get("hash", (built, pack_entry["offset"]))
+            openers[pack_entry["file"]] = (signature, functools.partial(_open_packed, name))
+    else:
+        def _open_file(img_path: str, char_id: str, source: _Source) -> TaggedImage:
+            if conf.image_cache is not None:
+                # not even opened until it's needed, then
+                # decoded into the cache each time it's missing
+                return TaggedImage(
+                    None,
+                    char_id,
+                    source=source,
+                    opener=functools.partial(Image.open, img_path),
+                    cache=conf.image_cache,
+                )
+            return TaggedImage(Image.open(img_path), char_id, source=source)
+
+        # one listing of the folder, since each one can be
+        # slow on network filesystems
+        with os.scandir(conf.image_path) as dir_entries:
+            for dir_entry in dir_entries:
+                if not dir_entry.is_file():
+                    continue
+                stat = dir_entry.stat()
+                openers[dir_entry.name] = (
+                    (stat.st_mtime_ns, stat.st_size),
+                    functools.partial(_open_file, dir_entry.path),
+                )
+
+    # char_id -> names of its image files
+    files_by_char: Dict[str, List[str]] = {}
+    for name in sorted(openers):
+        if name not in EXCLUDE_IMG_LIST:
+            files_by_char.setdefault(_get_char_id(name), []).append(name)
+
+    e = time.perf_counter_ns()
+    print(f"listed {len(openers)} files: {(e-s)/1000000} ms")
+
+    reusable: Dict[_Source, TaggedImage] = {
+        img.source: img
+        for img in previous or ()
+        if img.source is not None
+    }
+
+    def _should_load(char_id: str, cn_name: str) -> bool:
         en_name = TRANSLATIONS.get(cn_name)
         # there are some objects in the data file
         # which are not actual characters. these objects
@@ -65,24 +170,19 @@ def get_images(conf) -> List[TaggedImage]:
             return False
         if en_name in EXCLUDE_CHAR_LIST:
             return False
+        if char_id not in files_by_char:
+            return False
 
-        aliases = ALIASES.get(en_name)
-        if aliases is None:
+        if char_id not in conf.guess_index:
             # data files are automatically updated, while
-            # alias file is not, so warn when the alias file
-            # is out of date
-            print(f"missing alias entry for {en_name}")
-            aliases = ()
-
-        num_loaded = 0
-        for img_path in glob.glob(f"{conf.image_path}/{char_id}*"):
-            if os.path.basename(img_path) not in EXCLUDE_IMG_LIST:
-                images.append(TaggedImage(
-                    Image.open(img_path),
-                    en_name, cn_name, *aliases,
-                ))
-                num_loaded += 1
-        return num_loaded > 0
+            # the guess index is not, so warn when it is out
+            # of date (only the names below will be accepted)
+            print(f"missing guess index entry for {en_name} (rerun ak_data.py)")
+        # the names are always accepted, even by an index
+        # built without translations (without chinese names)
+        conf.guess_index.add(en_name, char_id)
+        conf.guess_index.add(cn_name, char_id)
+        return True
 
     with open(
         conf.character_list_file,
@@ -91,22 +191,51 @@ def get_images(conf) -> List[TaggedImage]:
         characters = json.load(data_file)
 
     loaded = set()
+    # (char_id, name) of every image, in order
+    sources: List[Tuple[str, str]] = []
     for char_id, char in characters.items():
-        if _load_character(char_id, char["name"].lower()):
+        if _should_load(char_id, char["name"].lower()):
             loaded.add(char_id)
+            sources.extend((char_id, name) for name in files_by_char[char_id])
 
-    for img_path in glob.glob(f"{conf.image_path}/*"):
-        name = os.path.basename(img_path)
-        # char_1234_abcd_...
-        # ^^^^^^^^^^^^^^
-        if name[:name.index("_", name.index("_", 5)+1)] not in loaded:
+    for name in openers:
+        if _get_char_id(name) not in loaded:
             print(f"skipped {name}")
 
-    print(f"{len(images)} images parsed")
-
-    if conf.preload_images:
-        for img in images:
-            img.image.load()
-        print("all images loaded")
+    def _open(source: Tuple[str, str]) -> Tuple[TaggedImage, bool]:
+        char_id, name = source
+        signature, opener = openers[name]
+        img = reusable.get((name, signature))
+        if img is not None:
+            return (img, False)
+        return (opener(char_id, (name, signature)), True)
+
+    s = time.perf_counter_ns()
+    # opening only reads headers (or maps pack pages),
+    # which is mostly waiting on the disk, so threads help
+    with futures.ThreadPoolExecutor(conf.load_threads) as pool:
+        results = list(pool.map(_open, sources))
+        images: List[TaggedImage] = [img for img, _ in results]
+        num_new = sum(1 for _, is_new in results if is_new)
+        e = time.perf_counter_ns()
+
+        num_removed = len(reusable) - (len(images) - num_new)
+        print(
+            f"{len(images)} images parsed"
+            f" ({num_new} loaded, {num_removed} dropped): {(e-s)/1000000} ms"
+        )
+
+        if conf.preload_images and conf.image_cache is not None:
+            print("not preloading images, since image_cache_size is set")
+        elif conf.preload_images:
+            s = time.perf_counter_ns()
+            # decoding releases the gil. does nothing for
+            # reused images which were already loaded
+            list(pool.map(
+                functools.partial(_preload, packed=conf.image_pack is not None),
+                images,
+            ))
+            e = time.perf_counter_ns()
+            print(f"all images loaded: {(e-s)/1000000} ms")
 
     return images
@@ -0,0 +1,96 @@
+import random
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
+
+
+# spacing in pixels between candidate center points, larger
+# values use less memory but give fewer starting positions
+CENTER_STEP = 4
+
+
+class CenterIndex(object):
+    __slots__ = (
+        "_xs",
+        "_ys",
+        "_valid",
+    )
+
+    def __init__(self, xs: np.ndarray, ys: np.ndarray, valid: np.ndarray):
+        # candidate center coordinates along each axis
+        self._xs = xs
+        self._ys = ys
+        # flat indices (y_index*len(xs) + x_index) of the
+        # candidates which pass the opacity threshold
+        self._valid = valid
+
+    def __len__(self) -> int:
+        return len(self._valid)
+
+    def choice(self) -> Tuple[int, int]:
+        i = int(self._valid[random.randrange(len(self._valid))])
+        y_index, x_index = divmod(i, len(self._xs))
+        return (int(self._xs[x_index]), int(self._ys[y_index]))
+
+
+def get_opaque_table(im: Image.Image) -> np.ndarray:
+    # the bot is deployed without api/, so this is a copy
+    # of api/image/crops.py, which builds the tables of
+    # packs. keep them the same.
+    # table[y, x] is the number of fully opaque pixels in
+    # the rect (0, 0, x, y), so the count inside any rect
+    # can be found with 4 lookups instead of a crop and
+    # a histogram. the extra row and column of zeros
+    # means rects touching the top/left edge don't need
+    # special cases
+    opaque = np.asarray(im.getchannel("A")) == 255
+    table = np.zeros((im.height+1, im.width+1), dtype=np.uint32)
+    opaque.cumsum(axis=0, dtype=np.uint32, out=table[1:, 1:])
+    table[1:, 1:].cumsum(axis=1, dtype=np.uint32, out=table[1:, 1:])
+    return table
+
+
+def get_center_index(
+    table: np.ndarray,
+    size: int, threshold: float,
+) -> CenterIndex:
+    # check every candidate center at once, using the
+    # same rects as image_generator._center_and_nudge
+    height = table.shape[0]-1
+    width = table.shape[1]-1
+    half_size = size//2
+
+    xs = np.arange(half_size, width-half_size+1, CENTER_STEP)
+    if len(xs) == 0:
+        xs = np.array([width//2])
+    ys = np.arange(half_size, height-half_size+1, CENTER_STEP)
+    if len(ys) == 0:
+        ys = np.array([height//2])
+
+    # the candidates never need nudging, they only
+    # get clamped when the crop is bigger than the image
+    if size >= width:
+        x0 = np.zeros_like(xs)
+        x1 = np.full_like(xs, width)
+    else:
+        x0 = xs-half_size
+        x1 = xs+half_size
+    if size >= height:
+        y0 = np.zeros_like(ys)
+        y1 = np.full_like(ys, height)
+    else:
+        y0 = ys-half_size
+        y1 = ys+half_size
+
+    def corner(ys: np.ndarray, xs: np.ndarray) -> np.ndarray:
+        # int64 so the subtraction can't wrap around
+        return table[np.ix_(ys, xs)].astype(np.int64)
+
+    counts = (
+        corner(y1, x1) - corner(y0, x1)
+        - corner(y1, x0) + corner(y0, x0)
+    )
+    area = int(x1[0]-x0[0])*int(y1[0]-y0[0])
+    valid = np.flatnonzero(counts >= threshold*area).astype(np.uint32)
+    return CenterIndex(xs, ys, valid)
@@ -0,0 +1,43 @@
+import asyncio
+from concurrent import futures
+from typing import Callable, Dict, TypeVar
+
+T = TypeVar("T")
+
+
+class RenderPool(object):
+    """Runs image rendering on worker threads so encoding an
+    image doesn't block the event loop (and every other game)
+
+    Each guild can only have a limited number of renders in
+    the pool at once, so one busy guild can't take up every
+    thread while others wait.
+
+    Args:
+        max_workers (int): The number of rendering threads.
+        per_guild (int): The number of renders one guild can
+            have running at the same time.
+    """
+
+    __slots__ = (
+        "_executor",
+        "_per_guild",
+        "_guild_slots",
+    )
+
+    def __init__(self, max_workers: int, per_guild: int):
+        self._executor = futures.ThreadPoolExecutor(max_workers, "render")
+        self._per_guild = per_guild
+        self._guild_slots: Dict[int, asyncio.Semaphore] = {}
+
+    async def run(self, guild_id: int, renderer: Callable[[], T]) -> T:
+        slots = self._guild_slots.get(guild_id)
+        if slots is None:
+            slots = asyncio.Semaphore(self._per_guild)
+            self._guild_slots[guild_id] = slots
+
+        async with slots:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                renderer,
+            )
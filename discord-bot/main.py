@@ -1,16 +1,25 @@
 import asyncio
-from typing import Callable, Dict, FrozenSet, List
+import functools
+from typing import Callable, Dict, FrozenSet, List, Optional, TypeVar
 
 import discord
 
 import cannedthighs
 from cannedthighs.Game import Game
+from cannedthighs.render_pool import RenderPool
+
+T = TypeVar("T")
 
 
 client = discord.Client()
 
 games: Dict[int, Game] = {}
 
+render_pool = RenderPool(
+    cannedthighs.conf.render_threads,
+    cannedthighs.conf.render_per_guild,
+)
+
 commands: FrozenSet[str] = frozenset((
     "start", "s",
     "expand", "e",
@@ -19,6 +28,7 @@ commands: FrozenSet[str] = frozenset((
     "score",
     "quit", "q",
     "reload",
+    "cache",
 ))
 
 
@@ -32,18 +42,33 @@ async def send_message_and_image(
     image_file.fp.close()
 
 
+def get_render_key(channel: discord.channel.TextChannel) -> int:
+    # group DMs and other channels without a guild by channel
+    guild: Optional[discord.Guild] = getattr(channel, "guild", None)
+    return channel.id if guild is None else guild.id
+
+
+async def render(
+    channel: discord.channel.TextChannel,
+    game: Game,
+    renderer: Callable[[], T],
+) -> T:
+    async with game.state_lock:
+        return await render_pool.run(get_render_key(channel), renderer)
+
+
 async def maybe_render(
     channel: discord.channel.TextChannel,
-    render_lock: asyncio.Lock,
+    game: Game,
     renderer: Callable[[], discord.File],
 ) -> None:
-    if render_lock.locked():
+    if game.render_lock.locked():
         return
 
-    async with render_lock:
+    async with game.render_lock:
         await send_message_and_image(
             channel,
-            renderer(),
+            await render(channel, game, renderer),
             "",
         )
         # maintain the lock for 1 second
@@ -94,34 +119,65 @@ async def on_message(msg: discord.Message):
                 except ValueError:
                     await msg.channel.send(f"Unknown argument: {args[1]}")
                     return
-            elif len(args) == 3:
+            elif len(args) == 3 or len(args) == 4:
                 if args[2] not in cannedthighs.conf.file_formats:
                     await msg.channel.send(f"Unknown argument: {args[2]}")
                     return
                 try:
-                    new_game = Game(int(args[1]), image_mode=args[2])
+                    num_rounds = int(args[1])
                 except ValueError:
                     await msg.channel.send(f"Unknown argument: {args[1]}")
                     return
+                tolerance: Optional[int] = None
+                if len(args) == 4:
+                    if not args[3].isdigit():
+                        await msg.channel.send(f"Unknown argument: {args[3]}")
+                        return
+                    tolerance = int(args[3])
+                new_game = Game(num_rounds, image_mode=args[2], tolerance=tolerance)
             else:
                 new_game = Game()
 
             games[msg.channel.id] = new_game
             await send_message_and_image(
                 msg.channel,
-                new_game.start_round(),
+                await render(msg.channel, new_game, new_game.start_round),
                 "Round 1:",
             )
             return
 
         if args[0] == "reload":
             if msg.author.id == cannedthighs.conf.bot_owner:
-                cannedthighs.conf.update(len(args) > 1)
+                # &reload: config only
+                # &reload images: also load new/changed images
+                # &reload images full: also reload every image
+                await asyncio.get_running_loop().run_in_executor(
+                    None,
+                    functools.partial(
+                        cannedthighs.conf.update,
+                        len(args) > 1,
+                        len(args) > 2 and args[2] == "full",
+                    ),
+                )
                 await msg.channel.send("Updated config")
             else:
                 await msg.channel.send("Only the bot owner can reload the bot's config")
             return
 
+        if args[0] == "cache":
+            image_cache = cannedthighs.conf.image_cache
+            if image_cache is None:
+                await msg.channel.send("Decoded images aren't cached (IMAGE_CACHE_SIZE is unset)")
+                return
+            stats = image_cache.stats()
+            await msg.channel.send(
+                f"{stats['resident']} resident"
+                f" ({stats['bytes']/1000000:.1f}/{stats['max_bytes']/1000000:.0f} MB),"
+                f" {stats['evictions']} evicted,"
+                f" {stats['hits']} hits, {stats['misses']} misses"
+            )
+            return
+
         # by now, args[0] must be expand, view, score, or quit:
         # all of which require a valid game
         if maybe_game is None:
@@ -131,17 +187,21 @@ async def on_message(msg: discord.Message):
         if args[0] == "expand" or args[0] == "e":
             await maybe_render(
                 msg.channel,
-                maybe_game.render_lock,
+                maybe_game,
                 maybe_game.get_help,
             )
         elif args[0] == "view" or args[0] == "v":
             await maybe_render(
                 msg.channel,
-                maybe_game.render_lock,
+                maybe_game,
                 maybe_game.view_image,
             )
         elif args[0] == "giveup" or args[0] == "g":
-            maybe_buf = maybe_game.end_round(None)
+            maybe_buf = await render(
+                msg.channel,
+                maybe_game,
+                functools.partial(maybe_game.end_round, None),
+            )
             await msg.channel.send("skipped round")
             if maybe_buf is None:
                 await end_game(msg.channel, maybe_game)
@@ -156,19 +216,26 @@ async def on_message(msg: discord.Message):
         elif args[0] == "quit" or args[0] == "q":
             await end_game(msg.channel, maybe_game)
     elif maybe_game is not None:
-        if maybe_game.verify_answer(msg.content):
-            maybe_buf = maybe_game.end_round(msg.author.id)
+        # check the answer while holding the lock, so it can't
+        # be checked against a round that's being changed
+        async with maybe_game.state_lock:
+            if not maybe_game.verify_answer(msg.content):
+                return
+            maybe_buf = await render_pool.run(
+                get_render_key(msg.channel),
+                functools.partial(maybe_game.end_round, msg.author.id),
+            )
 
-            first_line = msg.content.split("\n", 1)[0]
-            await msg.channel.send(f"> {first_line}\n<@{msg.author.id}> got the answer")
-            if maybe_buf is None:
-                await end_game(msg.channel, maybe_game)
-            else:
-                await send_message_and_image(
-                    msg.channel,
-                    maybe_buf,
-                    f"Round {maybe_game.current_round}:",
-                )
+        first_line = msg.content.split("\n", 1)[0]
+        await msg.channel.send(f"> {first_line}\n<@{msg.author.id}> got the answer")
+        if maybe_buf is None:
+            await end_game(msg.channel, maybe_game)
+        else:
+            await send_message_and_image(
+                msg.channel,
+                maybe_buf,
+                f"Round {maybe_game.current_round}:",
+            )
 
 
 client.run(cannedthighs.conf.discord_token)
@@ -0,0 +1,63 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from PIL import Image
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+GAMEDATA_PATH = os.path.join(BOT_PATH, "..", "gamedata")
+sys.path.insert(0, BOT_PATH)
+
+# not in gamedata/guess_index.json, only added by
+# image_setup.get_images from the translation data
+AMIYA_CN = "阿米娅"
+
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        # the bot reads gamedata/ from the working directory
+        self._cwd = os.getcwd()
+        self._dir = tempfile.mkdtemp()
+        os.chdir(self._dir)
+        shutil.copytree(GAMEDATA_PATH, "gamedata")
+
+        os.mkdir("images")
+        Image.new("RGBA", (300, 300), (255, 0, 0, 255)).save("images/char_002_amiya_1.png")
+        with open("chars.json", "w", encoding="utf-8") as f:
+            json.dump({"char_002_amiya": {"name": AMIYA_CN}}, f)
+        with open("tl.json", "w", encoding="utf-8") as f:
+            json.dump([{"name_cn": AMIYA_CN, "name_en": "Amiya"}], f)
+
+        os.environ.update({
+            "DISCORD_BOT_TOKEN": "token",
+            "BOT_OWNER": "1",
+            "TRANSLATION_FILE": "tl.json",
+            "CHARACTER_LIST_FILE": "chars.json",
+            "IMAGE_PATH": "images",
+        })
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        shutil.rmtree(self._dir)
+
+    def test_reload_keeps_chinese_names(self):
+        from cannedthighs import _Config
+
+        conf = _Config()
+        self.assertTrue(conf.guess_index.matches(AMIYA_CN, "char_002_amiya"))
+
+        # &reload without images
+        conf.update()
+        self.assertTrue(conf.guess_index.matches(AMIYA_CN, "char_002_amiya"))
+        self.assertTrue(conf.guess_index.matches("amiya", "char_002_amiya"))
+
+        # &reload images
+        conf.update(True)
+        self.assertTrue(conf.guess_index.matches(AMIYA_CN, "char_002_amiya"))
+
+
+if __name__ == "__main__":
+    unittest.main()
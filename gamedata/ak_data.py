@@ -1,4 +1,16 @@
 import json
+import unicodedata
+from typing import Dict, List
+
+
+# must match normalize() in discord-bot/cannedthighs/guesses.py
+# and normalizeGuess() in api/web/src/utils.ts
+def normalize(text: str) -> str:
+    # ignore case, width/compatibility forms, whitespace and
+    # punctuation, e.g. "Lancet-2" -> "lancet2"
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(c for c in text if c.isalnum())
+
 
 with open("../../../AN-EN-Tags/json/gamedata/zh_CN/gamedata/excel/character_table.json", encoding="utf-8") as f:
     chars = json.load(f)
@@ -20,9 +32,12 @@ for char in tl:
         tls[cn_name.lower()] = char["name_en"].lower()
 
 data = {}
+# normalized guess -> every char_id it's a valid answer for
+guesses: Dict[str, List[str]] = {}
 
 for char_id, char in chars.items():
-    en_name = tls.get(char["name"].lower())
+    cn_name = char["name"].lower()
+    en_name = tls.get(cn_name)
     if en_name is None or en_name in overrides["excludeCharacterList"]:
         continue
 
@@ -31,5 +46,16 @@ for char_id, char in chars.items():
         "aliases": aliases.get(en_name, []),
     }
 
+    for name in (en_name, cn_name, *data[char_id]["aliases"]):
+        form = normalize(name)
+        if form == "":
+            continue
+        ids = guesses.setdefault(form, [])
+        if char_id not in ids:
+            ids.append(char_id)
+
 with open("ak_data.json", "w", encoding="utf-8") as f:
     json.dump(data, f, indent=2)
+
+with open("guess_index.json", "w", encoding="utf-8") as f:
+    json.dump({"version": 1, "guesses": guesses}, f, ensure_ascii=False, indent=2)
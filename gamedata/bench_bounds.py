@@ -0,0 +1,61 @@
+# compares the numpy bounds detection in image_formatter.py
+# against the original recursive binary search, on the
+# same source images image_formatter.py reads. both run
+# the same search with the same >99.9% empty rule on each
+# half-block, so they must give the same bounds: any
+# image where they don't is printed
+
+# example usage:
+# $ python bench_bounds.py "../AN-EN-Tags"
+#          ^               ^
+# name of script           |
+# path to the base folder of AN-EN-Tags
+
+import glob
+import os
+import sys
+import time
+
+from PIL import Image, ImageEnhance
+
+from image_formatter import get_bounds, get_bounds_numpy
+
+
+def main() -> None:
+    source = sys.argv[1]
+
+    recursive_ns = 0
+    numpy_ns = 0
+    mismatches = 0
+    files = sorted(glob.glob(f"{source}/img/characters/*"))
+
+    for file in files:
+        im: Image.Image = Image.open(file)
+        im.load()
+        if im.mode != "RGBA":
+            im = im.convert("RGBA")
+        if im.width > 1024 or im.height > 1024:
+            im = im.reduce(2)
+
+        # include the work each version does before searching
+        s = time.perf_counter_ns()
+        expected = get_bounds(ImageEnhance.Contrast(im.getchannel("A")).enhance(5.0))
+        e = time.perf_counter_ns()
+        recursive_ns += e-s
+
+        s = time.perf_counter_ns()
+        actual = get_bounds_numpy(im.getchannel("A"))
+        e = time.perf_counter_ns()
+        numpy_ns += e-s
+
+        if actual != expected:
+            mismatches += 1
+            print(f"{os.path.basename(file)}: recursive {expected}, numpy {actual}")
+
+    print(f"{len(files)} images, {mismatches} mismatches")
+    print(f"recursive: {recursive_ns/1000000}ms ({recursive_ns/1000000/max(len(files), 1)}ms/image)")
+    print(f"numpy: {numpy_ns/1000000}ms ({numpy_ns/1000000/max(len(files), 1)}ms/image)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+# analyses the images made by image_formatter.py once, so
+# the image server can honour the charset and difficulty
+# of /new and /round by picking from precomputed buckets
+# instead of filtering or retrying at request time
+#
+# for each image, records:
+#   opaque: the fraction of fully opaque pixels
+#   density: for each step's crop size, the fraction of
+#     candidate centers (same grid as the image server's
+#     center index) whose crop passes the opacity threshold
+#   distinctiveness: how much detail the opaque pixels have
+#     (mean luma gradient, 0 to 1). flat areas of one color
+#     are hard to recognise from a small crop
+#   ease: density of the first step times distinctiveness,
+#     used to rank images into difficulty levels
+#
+# then writes every image's stats and the buckets: for
+# each charset (see CHARSETS), the images of each
+# difficulty. difficulty 0 is every usable image, 1 to
+# DIFFICULTIES are equal parts of the images from easiest
+# to hardest. images with no usable first step (which /new
+# could never use) aren't in any bucket
+#
+# exmple usage:
+# $ python image_analysis.py "images" "analysis.json"
+#          ^                 ^        ^
+# name of script             |        |
+# path to the folder of images from image_formatter.py
+#                                     |
+# path of the index to write (the image server's ANALYSIS_PATH)
+#
+# options:
+#   --threshold T: required fraction of opaque pixels in a
+#     crop (default: 0.4, must match the server's
+#     DEFAULT_THRESHOLD)
+#   --padding P, --center-step S: must match the server's
+#     PADDING and CENTER_STEP (default: the server's defaults)
+#   --workers N: number of processes to use
+#     (default: number of cpus)
+
+import argparse
+from concurrent import futures
+import json
+import os
+import pathlib
+import re
+import sys
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+# the crop sizes and candidate centers must be the same as
+# the image server's, so its code is used (this script is
+# run from inside gamedata/)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from api.image import crops  # noqa: E402
+
+
+# change whenever the format of the index changes
+ANALYSIS_VERSION = 1
+
+# number of difficulty levels above 0 (any difficulty)
+DIFFICULTIES = 3
+
+# images are scaled down to at most this size for
+# distinctiveness, which doesn't need every pixel
+DETAIL_SIZE = 256
+
+# suffix of the default art of each operator, e.g.
+# char_002_amiya_1, char_002_amiya_e1 (see
+# get_output_name in image_formatter.py). anything else
+# (char_002_amiya_epoque) is a skin
+_DEFAULT_ART = re.compile(r"^char_\d+_[^_]+_e?\d+$")
+
+
+def is_default_art(name: str) -> bool:
+    return _DEFAULT_ART.match(name) is not None
+
+
+# the charset parameter of /new and /round is an index
+# in this list: (description, whether an image is in it)
+CHARSETS: List[Tuple[str, Callable[[str], bool]]] = [
+    ("every image", lambda name: True),
+    ("default art only", is_default_art),
+    ("skins only", lambda name: not is_default_art(name)),
+]
+
+
+def get_density(table: np.ndarray, size: int, threshold: float, padding: int, center_step: int) -> float:
+    # fraction of the candidate centers which the image
+    # server would find valid
+    index = crops.get_center_index(table, size, threshold, padding, center_step)
+    return len(index.valid) / (len(index.xs)*len(index.ys))
+
+
+def get_distinctiveness(im: Image.Image) -> float:
+    im = im.copy()
+    im.thumbnail((DETAIL_SIZE, DETAIL_SIZE))
+    luma = np.asarray(im.convert("L"), dtype=np.float32)
+    opaque = np.asarray(im.getchannel("A")) == 255
+
+    # gradients between neighbouring pixels which are
+    # both opaque, so the outline doesn't count as detail
+    dx = np.abs(np.diff(luma, axis=1))[opaque[:, 1:] & opaque[:, :-1]]
+    dy = np.abs(np.diff(luma, axis=0))[opaque[1:, :] & opaque[:-1, :]]
+    count = dx.size + dy.size
+    if count == 0:
+        return 0
+    return float((dx.sum() + dy.sum()) / count / 255)
+
+
+def analyse(path: str, threshold: float, padding: int, center_step: int) -> Dict[str, Any]:
+    # runs in a worker process
+    s = time.perf_counter_ns()
+
+    im: Image.Image = Image.open(path)
+    im.load()
+    if im.mode != "RGBA":
+        im = im.convert("RGBA")
+
+    table = crops.get_opaque_table(im)
+    density = [
+        get_density(table, crops.get_size(step, 0), threshold, padding, center_step)
+        for step in range(crops.LAST_STEP+1)
+    ]
+    distinctiveness = get_distinctiveness(im)
+
+    e = time.perf_counter_ns()
+    return {
+        "opaque": int(table[-1, -1]) / (im.width*im.height),
+        "density": density,
+        "distinctiveness": distinctiveness,
+        "ease": density[0]*distinctiveness,
+        "ms": (e-s)/1000000,
+    }
+
+
+def get_buckets(stats: Dict[str, Dict[str, Any]]) -> List[List[List[str]]]:
+    # usable images from easiest to hardest
+    ranked = sorted(
+        (name for name, stat in stats.items() if stat["density"][0] > 0),
+        key=lambda name: stats[name]["ease"],
+        reverse=True,
+    )
+    for i, name in enumerate(ranked):
+        stats[name]["difficulty"] = 1 + i*DIFFICULTIES//len(ranked)
+
+    buckets = []
+    for _, is_in_charset in CHARSETS:
+        names = [name for name in ranked if is_in_charset(name)]
+        levels = [sorted(names)]
+        for difficulty in range(1, DIFFICULTIES+1):
+            levels.append(sorted(
+                name for name in names
+                if stats[name]["difficulty"] == difficulty
+            ))
+        buckets.append(levels)
+    return buckets
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    # source: path to the folder of images from image_formatter.py
+    parser.add_argument("source")
+    # dest: path of the index to write
+    parser.add_argument("dest")
+    parser.add_argument("--threshold", type=float, default=0.4)
+    parser.add_argument("--padding", type=int, default=crops.DEFAULT_PADDING)
+    parser.add_argument("--center-step", type=int, default=crops.DEFAULT_CENTER_STEP)
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+
+    files = sorted(path for path in pathlib.Path(args.source).iterdir() if path.is_file())
+
+    s = time.perf_counter_ns()
+    stats: Dict[str, Dict[str, Any]] = {}
+    with futures.ProcessPoolExecutor(args.workers) as pool:
+        pending = {
+            pool.submit(analyse, str(path), args.threshold, args.padding, args.center_step): path.stem
+            for path in files
+        }
+        for future in futures.as_completed(pending):
+            name = pending[future]
+            stats[name] = future.result()
+            print(f"{name} {stats[name].pop('ms')}ms")
+
+    buckets = get_buckets(stats)
+    with open(args.dest, "w", encoding="utf-8") as f:
+        json.dump({
+            "version": ANALYSIS_VERSION,
+            "threshold": args.threshold,
+            "center_step": args.center_step,
+            "padding": args.padding,
+            "charsets": [description for description, _ in CHARSETS],
+            "images": {name: stats[name] for name in sorted(stats)},
+            "buckets": buckets,
+        }, f)
+
+    e = time.perf_counter_ns()
+    for description, levels in zip((description for description, _ in CHARSETS), buckets):
+        print(f"{description}: {' / '.join(str(len(level)) for level in levels)} images")
+    print(f"{len(stats)} images analysed in {(e-s)/1000000000}s")
+
+
+if __name__ == "__main__":
+    main()
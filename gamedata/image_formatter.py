@@ -3,6 +3,16 @@
 # images are uniform size, then trims each image to
 # the bounding box of the opaque contents, plus
 # padding (i.e. gets rid of excess transparent pixels)
+#
+# alongside the trimmed pngs, builds a pack of the
+# images for the image server and bot (see
+# api/image/store.py): the raw RGBA pixels, summed-area
+# tables of opaque pixels and the bounds of each image,
+# so servers only need to map precomputed files at
+# startup. images are processed in parallel and written
+# as soon as they are done, and source files which
+# haven't changed since the last run are copied from the
+# previous pack instead of being processed again
 
 # exmple usage:
 # $ python image_formatter.py "../AN-EN-Tags" "images"
@@ -10,15 +20,36 @@
 # name of script              |               |
 # path to the base folder of AN-EN-Tags       |
 # path to the folder inside which files should be saved
+#
+# options:
+#   --pack PATH: folder to write the pack to
+#     (default: the output folder with "-pack" appended)
+#   --workers N: number of processes to use
+#     (default: number of cpus)
+#   --tiles: build a tiled pack, which is compressed and lets
+#     crops decompress only the tiles they overlap (see
+#     api/image/store.py), instead of raw pixels
+#   --yes: don't ask before saving
 
+import argparse
+from concurrent import futures
 import glob
+import hashlib
 import json
 import os
 import sys
 import time
-from typing import FrozenSet, List, Tuple
+from typing import Any, BinaryIO, Dict, FrozenSet, List, Optional, Tuple
+import zlib
 
-from PIL import Image, ImageEnhance
+import numpy as np
+from PIL import Image
+
+# the opaque pixel tables must be the same as the image
+# server's, so its code is used (this script is run from
+# inside gamedata/)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from api.image import crops  # noqa: E402
 
 
 # amount of transparent padding to add
@@ -26,15 +57,20 @@ PADDING = 40
 # file format of output
 FORMAT = "png"
 
-# source: path to the base folder of AN-EN-Tags
-# dest: path to the folder inside which files should be saved
-SOURCE, DEST = sys.argv[1:]
-
-# don't process/output files specified here
-with open("image_setup.json", encoding="utf-8") as setup_data:
-    EXCLUDE: FrozenSet[str] = frozenset(json.load(setup_data)["excludeImageList"])
+# change whenever processing changes in a way that
+# should invalidate previous outputs
+PIPELINE_VERSION = 3
 
-images: List[Tuple[Image.Image, str]] = []
+# must match api/image/store.py
+PACK_VERSION = 1
+ALIGNMENT = 64
+TILE_SIZE = 128
+PIXELS_FILE = "pixels.bin"
+TILES_FILE = "tiles.bin"
+OPAQUE_FILE = "opaque.bin"
+INDEX_FILE = "index.json"
+# hashes of the source files used to build the pack
+SOURCES_FILE = "sources.json"
 
 
 # directions:
@@ -140,59 +176,359 @@ def get_bounds(im: Image.Image) -> Tuple[int, int, int, int]:
     return (left-PADDING, top-PADDING, right+PADDING, bottom+PADDING)
 
 
-def crop(im: Image.Image) -> Image.Image:
-    return im.crop(get_bounds(
-        # the R, G, and B channels don't help us find
-        # the bounds, discard them to save a lot of time.
-        # some of the 2048x2048 images have a dumb border
-        # 1 pixel wide with an alpha value of 1, so
-        # increase the contrast by a decent amount to get
-        # rid of the border
-        ImageEnhance.Contrast(im.getchannel("A")).enhance(5.0),
-    ))
-
-
-def save(images: List[Tuple[Image.Image, str]]):
-    for im, name in images:
-        # example name: char_002_amiya_epoque#4.png
-        # remove the #4 (# and a number) found in
-        # skin names
-        try:
-            name = f"{name[:name.index('#')]}.png"
-        except ValueError:
-            pass
-
-        if name == "char_002_amiya_1+.png":
-            # remove "+" character
-            name = "char_002_amiya_e1.png"
-        elif name == "char_1001_amiya2_2.png":
-            # amiya doesn't have a different alter name in
-            # game files so change her id to the original
-            name = "char_002_amiya_guard2.png"
-
-        im.save(f"{DEST}/{name}", FORMAT)
-
-
-for file in glob.glob(f"{SOURCE}/img/characters/*"):
-    filename = os.path.basename(file)
-    if filename not in EXCLUDE:
-        im: Image.Image = Image.open(file)
-        im.load()
-        print(filename, end=" ")
-
-        s = time.perf_counter_ns()
-
-        if im.width > 1024 or im.height > 1024:
-            im = im.reduce(2)
-
-        images.append((crop(im), filename))
-
-        e = time.perf_counter_ns()
-        print(f"{(e-s)/1000000}ms")
-
-# make sure the user doesn't accidentally bomb a
-# random folder with hundreds of images
-if input(
-    f"save {len(images)} images to '{os.path.realpath(DEST)}/*.{FORMAT}'? (y/n) "
-).lower() == "y":
-    save(images)
+def _check_dir_table(
+    table: np.ndarray,
+    inner: int, outer: int,
+    low: int, high: int,
+    direction: int,
+) -> int:
+    # check_dir, but counting the non-empty pixels of each
+    # half with 4 lookups in a summed-area table instead of
+    # a crop and a histogram, so it takes the same steps
+    # and gives the same results
+    while abs(outer-inner) > 1:
+        half = inner + (outer-inner)//2
+
+        if direction == 0:
+            rect = (low, outer, high, half)
+        elif direction == 1:
+            rect = (half, low, outer, high)
+        elif direction == 2:
+            rect = (low, half, high, outer)
+        else:
+            rect = (outer, low, half, high)
+        area = (rect[2]-rect[0])*(rect[3]-rect[1])
+
+        if (area - crops.get_rect_count(table, rect)) / area > 0.999:
+            # consider >99.9% empty as empty
+            outer = half
+        else:
+            inner = half
+
+    return outer
+
+
+def get_bounds_numpy(alpha: Image.Image) -> Tuple[int, int, int, int]:
+    # equivalent to get_bounds(ImageEnhance.Contrast(alpha).enhance(5.0))
+    # but thresholds the alpha plane once instead of
+    # enhancing every pixel, then runs the same binary
+    # search on a summed-area table of the result instead
+    # of cropping (see bench_bounds.py)
+    a = np.asarray(alpha)
+    # Contrast(5.0) maps each pixel to mean + 5*(a-mean),
+    # which truncates to 0 when it's below 1, i.e. when
+    # 5*a < 4*mean + 1
+    mean = int(a.mean() + 0.5)
+    table = crops.get_summed_table(a >= -(-(4*mean + 1)//5))
+
+    width = alpha.width
+    height = alpha.height
+    left = _check_dir_table(table,   width//2,  0,      0,    height, 3)
+    top = _check_dir_table(table,    height//2, 0,      left, width,  0)
+    right = _check_dir_table(table,  width//2,  width,  top,  height, 1)
+    bottom = _check_dir_table(table, height//2, height, left, right,  2)
+    return (left-PADDING, top-PADDING, right+PADDING, bottom+PADDING)
+
+
+def crop(im: Image.Image) -> Tuple[Image.Image, Tuple[int, int, int, int]]:
+    # the R, G, and B channels don't help us find
+    # the bounds, discard them to save a lot of time.
+    # some of the 2048x2048 images have a dumb border
+    # 1 pixel wide with an alpha value of 1, which
+    # get_bounds_numpy ignores the same way the
+    # recursive version does after increasing the
+    # contrast by a decent amount
+    bounds = get_bounds_numpy(im.getchannel("A"))
+    return (im.crop(bounds), bounds)
+
+
+def get_output_name(name: str) -> str:
+    # example name: char_002_amiya_epoque#4.png
+    # remove the #4 (# and a number) found in
+    # skin names
+    try:
+        name = f"{name[:name.index('#')]}.png"
+    except ValueError:
+        pass
+
+    if name == "char_002_amiya_1+.png":
+        # remove "+" character
+        name = "char_002_amiya_e1.png"
+    elif name == "char_1001_amiya2_2.png":
+        # amiya doesn't have a different alter name in
+        # game files so change her id to the original
+        name = "char_002_amiya_guard2.png"
+
+    return name
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256(f"{PIPELINE_VERSION}:{PADDING}:{FORMAT}".encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_tiles(im: Image.Image) -> List[bytes]:
+    pixels = np.asarray(im)
+    tiles = []
+    for top in range(0, im.height, TILE_SIZE):
+        for left in range(0, im.width, TILE_SIZE):
+            tile = pixels[top:top+TILE_SIZE, left:left+TILE_SIZE]
+            if not tile[..., 3].any():
+                # fully transparent tiles are stored empty
+                tiles.append(b"")
+            else:
+                tiles.append(zlib.compress(tile.tobytes()))
+    return tiles
+
+
+def process(path: str, dest: str, tiled: bool) -> Dict[str, Any]:
+    # runs in a worker process. saves the trimmed image and
+    # returns everything needed for the pack, so nothing is
+    # kept around after the result has been written
+    s = time.perf_counter_ns()
+
+    im: Image.Image = Image.open(path)
+    im.load()
+    if im.mode != "RGBA":
+        im = im.convert("RGBA")
+
+    if im.width > 1024 or im.height > 1024:
+        im = im.reduce(2)
+
+    im, bounds = crop(im)
+
+    name = get_output_name(os.path.basename(path))
+    im.save(os.path.join(dest, name), FORMAT)
+
+    result: Dict[str, Any] = {
+        "file": name,
+        "width": im.width,
+        "height": im.height,
+        "bounds": bounds,
+        "opaque": crops.get_opaque_table(im).tobytes(),
+    }
+    if tiled:
+        result["tiles"] = get_tiles(im)
+    else:
+        result["pixels"] = im.tobytes()
+
+    e = time.perf_counter_ns()
+    result["ms"] = (e-s)/1000000
+    return result
+
+
+class _PackWriter(object):
+    # appends images to a new pack, either from processed
+    # results or by copying them out of the previous pack
+
+    def __init__(self, pack_path: str, old_pack: Optional[Dict[str, Any]], tiled: bool):
+        self._pack_path = pack_path
+        self._tiled = tiled
+        # raw pixels or tiles, whichever this pack has
+        self._data_file = TILES_FILE if tiled else PIXELS_FILE
+        self._data = open(os.path.join(pack_path, f"{self._data_file}.tmp"), "wb")
+        self._opaque = open(os.path.join(pack_path, f"{OPAQUE_FILE}.tmp"), "wb")
+
+        # images can only be copied from a pack of the same kind
+        if old_pack is not None and old_pack.get("tile_size") != (TILE_SIZE if tiled else None):
+            old_pack = None
+        self._old_pack = old_pack
+        self._old_data: Optional[BinaryIO] = None
+        self._old_opaque: Optional[BinaryIO] = None
+        if old_pack is not None:
+            self._old_data = open(os.path.join(pack_path, self._data_file), "rb")
+            self._old_opaque = open(os.path.join(pack_path, OPAQUE_FILE), "rb")
+        self.entries: Dict[str, Dict[str, Any]] = {}
+
+    @staticmethod
+    def _append(f: BinaryIO, data: bytes) -> int:
+        offset = -(-f.tell()//ALIGNMENT)*ALIGNMENT
+        f.seek(offset)
+        f.write(data)
+        return offset
+
+    def _append_tiles(self, tiles: List[bytes]) -> List[int]:
+        # tiles of one image are contiguous, so only the
+        # first is aligned
+        offsets = [self._append(self._data, b"")]
+        for tile in tiles:
+            self._data.write(tile)
+            offsets.append(offsets[-1] + len(tile))
+        return offsets
+
+    def add(self, result: Dict[str, Any], digest: str) -> None:
+        name = os.path.splitext(result["file"])[0]
+        entry: Dict[str, Any] = {
+            "file": result["file"],
+            "hash": digest,
+            "opaque_offset": self._append(self._opaque, result["opaque"]),
+            "width": result["width"],
+            "height": result["height"],
+            "bounds": result["bounds"],
+        }
+        if self._tiled:
+            entry["tile_offsets"] = self._append_tiles(result["tiles"])
+        else:
+            entry["offset"] = self._append(self._data, result["pixels"])
+        self.entries[name] = entry
+
+    def copy(self, name: str, digest: str) -> bool:
+        if self._old_pack is None or self._old_data is None or self._old_opaque is None:
+            return False
+        entry = self._old_pack["images"].get(name)
+        if entry is None or "opaque_offset" not in entry:
+            return False
+
+        width = entry["width"]
+        height = entry["height"]
+        self._old_opaque.seek(entry["opaque_offset"])
+        new_entry = {
+            **entry,
+            "hash": digest,
+            "opaque_offset": self._append(
+                self._opaque,
+                self._old_opaque.read((width+1)*(height+1)*4),
+            ),
+        }
+        if self._tiled:
+            old_offsets: List[int] = entry["tile_offsets"]
+            self._old_data.seek(old_offsets[0])
+            start = self._append(self._data, self._old_data.read(old_offsets[-1]-old_offsets[0]))
+            new_entry["tile_offsets"] = [offset-old_offsets[0]+start for offset in old_offsets]
+        else:
+            self._old_data.seek(entry["offset"])
+            new_entry["offset"] = self._append(self._data, self._old_data.read(width*height*4))
+        self.entries[name] = new_entry
+        return True
+
+    def finish(self) -> None:
+        for f in (self._data, self._opaque, self._old_data, self._old_opaque):
+            if f is not None:
+                f.close()
+        for file in (self._data_file, OPAQUE_FILE):
+            os.replace(
+                os.path.join(self._pack_path, f"{file}.tmp"),
+                os.path.join(self._pack_path, file),
+            )
+        # the other kind of data is no longer used
+        other = PIXELS_FILE if self._tiled else TILES_FILE
+        if os.path.exists(os.path.join(self._pack_path, other)):
+            os.remove(os.path.join(self._pack_path, other))
+
+        index: Dict[str, Any] = {"version": PACK_VERSION, "images": self.entries}
+        if self._tiled:
+            index["tile_size"] = TILE_SIZE
+        # write the index last so a partially written
+        # pack is never picked up
+        with open(os.path.join(self._pack_path, INDEX_FILE), "w") as index_file:
+            json.dump(index, index_file)
+
+
+def _load_json(path: str) -> Optional[Any]:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    # source: path to the base folder of AN-EN-Tags
+    parser.add_argument("source")
+    # dest: path to the folder inside which files should be saved
+    parser.add_argument("dest")
+    parser.add_argument("--pack")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--tiles", action="store_true")
+    parser.add_argument("--yes", action="store_true")
+    args = parser.parse_args()
+
+    source: str = args.source
+    dest: str = args.dest
+    # not inside dest, since everything in dest is
+    # treated as an image
+    pack_path: str = args.pack or f"{dest.rstrip('/')}-pack"
+
+    # don't process/output files specified here
+    with open("image_setup.json", encoding="utf-8") as setup_data:
+        exclude: FrozenSet[str] = frozenset(json.load(setup_data)["excludeImageList"])
+
+    files = sorted(
+        file for file in glob.glob(f"{source}/img/characters/*")
+        if os.path.basename(file) not in exclude
+    )
+
+    # make sure the user doesn't accidentally bomb a
+    # random folder with hundreds of images
+    if not args.yes and input(
+        f"save {len(files)} images to '{os.path.realpath(dest)}/*.{FORMAT}'"
+        f" and '{os.path.realpath(pack_path)}'? (y/n) "
+    ).lower() != "y":
+        return
+
+    os.makedirs(dest, exist_ok=True)
+    os.makedirs(pack_path, exist_ok=True)
+
+    old_sources: Dict[str, str] = _load_json(os.path.join(pack_path, SOURCES_FILE)) or {}
+    old_pack = _load_json(os.path.join(pack_path, INDEX_FILE))
+    if old_pack is not None and old_pack.get("version") != PACK_VERSION:
+        old_pack = None
+
+    s = time.perf_counter_ns()
+    writer = _PackWriter(pack_path, old_pack, args.tiles)
+    sources: Dict[str, str] = {}
+    num_skipped = 0
+
+    with futures.ProcessPoolExecutor(args.workers) as pool:
+        pending: Dict["futures.Future[Dict[str, Any]]", str] = {}
+        # only a few images are submitted ahead of the
+        # workers, so finished results don't pile up in
+        # memory while the rest are hashed and submitted
+        max_pending = 2 * (args.workers or os.cpu_count() or 1)
+
+        # write each result as soon as it's ready so only
+        # a few images are ever held in memory
+        def write_results(return_when: str) -> None:
+            done, _ = futures.wait(pending, return_when=return_when)
+            for future in done:
+                result = future.result()
+                writer.add(result, sources[pending.pop(future)])
+                print(f"{result['file']} {result['ms']}ms")
+
+        for file in files:
+            filename = os.path.basename(file)
+            digest = hash_file(file)
+            sources[filename] = digest
+
+            output = get_output_name(filename)
+            if (
+                old_sources.get(filename) == digest
+                and os.path.exists(os.path.join(dest, output))
+                and writer.copy(os.path.splitext(output)[0], digest)
+            ):
+                num_skipped += 1
+                continue
+
+            if len(pending) >= max_pending:
+                write_results(futures.FIRST_COMPLETED)
+            pending[pool.submit(process, file, dest, args.tiles)] = filename
+
+        write_results(futures.ALL_COMPLETED)
+
+    writer.finish()
+    with open(os.path.join(pack_path, SOURCES_FILE), "w", encoding="utf-8") as sources_file:
+        json.dump(sources, sources_file, indent=2)
+
+    e = time.perf_counter_ns()
+    print(
+        f"{len(writer.entries)} images saved ({num_skipped} unchanged)"
+        f" in {(e-s)/1000000000}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
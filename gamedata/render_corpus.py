@@ -0,0 +1,141 @@
+# pre-renders every step of every seeded starting position
+# of every image into a corpus for the image server (see
+# api/image/corpus.py), so it only has to read files for
+# seeded rounds
+#
+# renders with the image server itself, with the same
+# environment variables as the server which will use the
+# corpus (IMAGE_PATH/PACK_PATH, FORMAT_PATH, CALIBRATION_PATH,
+# DEFAULT_THRESHOLD, SEEDED_POSITIONS...). renders which are
+# still valid (same image, same format settings and
+# calibration) are kept, so rebuilding after adding or
+# reformatting images is quick. with IMAGE_PATH, images
+# count as changed when their files are modified or copied
+# (see main.get_image_hash), so build from the folder the
+# server will use
+#
+# exmple usage:
+# $ IMAGE_PATH="$PWD/images" FORMAT_PATH="$PWD/formats.json" \
+#     python render_corpus.py "corpus" --modes optimized
+#                             ^
+# path to the corpus folder (the image server's CORPUS_PATH)
+#
+# options:
+#   --modes MODE [MODE ...]: formats.json modes to render
+#     (default: DEFAULT_FORMAT)
+#   --workers N: number of threads to use
+#     (default: number of cpus)
+
+import argparse
+from concurrent import futures
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# renders must be the same as the image server's, so its
+# code is used (this script is run from inside gamedata/).
+# importing it loads every image
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from api.image import corpus, crops, main as server  # noqa: E402
+
+
+def _write_object(objects_path: str, data: bytes, format: str) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    name = f"{digest[:2]}/{digest}.{format}"
+    path = os.path.join(objects_path, name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # renamed into place so a crash never leaves a
+        # partial file under a valid name
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return name
+
+
+def build(dest: str, modes: Optional[List[str]], workers: Optional[int]) -> None:
+    if modes is None:
+        modes = [server.DEFAULT_FORMAT]
+    for mode in modes:
+        if mode not in server.FILE_FORMATS:
+            raise ValueError(f"unknown mode {mode}")
+
+    objects_path = os.path.join(dest, corpus.OBJECTS_DIR)
+    os.makedirs(objects_path, exist_ok=True)
+
+    image_hashes = {char_id: server.get_image_hash(char_id) for char_id in server.char_ids}
+    fingerprints = {mode: server.get_format_fingerprint(mode) for mode in server.FILE_FORMATS}
+
+    # renders still valid from a previous build
+    renders: Dict[str, corpus.CorpusFile] = {}
+    if os.path.exists(os.path.join(dest, corpus.MANIFEST_FILE)):
+        previous = corpus.Corpus(
+            dest, fingerprints,
+            # images which were removed never match
+            lambda char_id: image_hashes.get(char_id, ""),
+        )
+        for key in previous.files:
+            file = previous.get(key)
+            if file is not None and os.path.exists(previous.get_path(file)):
+                renders[key] = file
+
+    # every distinct crop a seeded round can ask for. the
+    # first step's size decides the valid positions, and
+    # it's the same for every difficulty
+    keys: Dict[str, Tuple[str, Tuple[int, int, int, int], str]] = {}
+    for char_id in server.char_ids:
+        im = server.images[char_id]
+        index = server.get_center_index(char_id, crops.get_size(0, 0), server.DEFAULT_THRESHOLD)
+        for x, y in server.get_seeded_positions(index):
+            for step in range(crops.LAST_STEP+1):
+                rect = server._center_and_nudge(x, y, crops.get_size(step, 0), im.width, im.height)
+                for mode in modes:
+                    key = server._get_cache_key(char_id, rect, mode)
+                    if key not in renders:
+                        keys[key] = (char_id, rect, mode)
+
+    def render(key: str) -> Tuple[str, corpus.CorpusFile]:
+        char_id, rect, mode = keys[key]
+        stream, format = server._get_byte_stream(char_id, rect, mode)
+        return (key, (_write_object(objects_path, stream.getvalue(), format), format))
+
+    print(f"rendering {len(keys)} images ({len(renders)} already rendered)")
+    s = time.perf_counter_ns()
+    with futures.ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        for i, (key, file) in enumerate(pool.map(render, keys)):
+            renders[key] = file
+            if (i+1) % 1000 == 0:
+                print(f"{i+1}/{len(keys)}")
+    e = time.perf_counter_ns()
+
+    manifest_path = os.path.join(dest, corpus.MANIFEST_FILE)
+    with open(f"{manifest_path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({
+            "version": corpus.CORPUS_VERSION,
+            "formats": fingerprints,
+            "images": image_hashes,
+            "renders": renders,
+        }, f)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    print(f"{len(renders)} renders in the corpus, {len(keys)} new in {(e-s)/1000000000}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    # dest: the corpus folder
+    parser.add_argument("dest")
+    parser.add_argument("--modes", nargs="+")
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+
+    build(args.dest, args.modes, args.workers)
+
+
+if __name__ == "__main__":
+    main()